@@ -1,148 +1,975 @@
 #!/usr/bin/env python3
 
-import contextlib
+import argparse
+import gc
+import json
 import logging
+import signal
 import time
+import dbus
 from gi.repository import GLib as gobject
 from dbus.mainloop.glib import DBusGMainLoop
 import sys
 import os
-import _thread as thread
-from homemanager_decoder import HomeManager20, MCAST_GRP
+from homemanager_archive import ArchiveWriter, ARCHIVE_DIR
+from homemanager_history import History, HistoryServer, SOCKET_PATH as HISTORY_SOCKET
+from homemanager_decoder import HomeManager20, Measurements, Histogram, MCAST_GRP, RateLimitedLog, add_relay_arguments, add_socket_arguments, relays, socket_options
 
 # necessary packages from victron
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '/opt/victronenergy/dbus-systemcalc-py/ext/velib_python')) # './ext/velib_python'
 from vedbus import VeDbusService
 
 VERSION = '2024.01'
+STARTED = time.monotonic() # startup times are measured from here
+
+SERVICE_PREFIX = 'com.victronenergy'
+SERVICE_CONNECTION = 'tcpip_239_12_255_254'
+ROLES = ('grid', 'pvinverter', 'acload')
+
+# A path is only written when its value moved further than this from the last published value
+DEADBANDS = {
+    '/Ac/Power': 0.5,
+    '/Ac/L1/Power': 0.5,
+    '/Ac/L2/Power': 0.5,
+    '/Ac/L3/Power': 0.5,
+    '/Ac/Current': 0.01,
+    '/Ac/L1/Current': 0.01,
+    '/Ac/L2/Current': 0.01,
+    '/Ac/L3/Current': 0.01,
+    '/Ac/L1/Voltage': 0.1,
+    '/Ac/L2/Voltage': 0.1,
+    '/Ac/L3/Voltage': 0.1,
+    '/Ac/Energy/Forward': 0.001,
+    '/Ac/Energy/Reverse': 0.001,
+    '/Ac/L1/Energy/Forward': 0.001,
+    '/Ac/L2/Energy/Forward': 0.001,
+    '/Ac/L3/Energy/Forward': 0.001,
+    '/Ac/L1/Energy/Reverse': 0.001,
+    '/Ac/L2/Energy/Reverse': 0.001,
+    '/Ac/L3/Energy/Reverse': 0.001,
+    '/Ac/Frequency': 0.01,
+    '/Ac/PowerFactor': 0.01,
+    '/Ac/L1/PowerFactor': 0.01,
+    '/Ac/L2/PowerFactor': 0.01,
+    '/Ac/L3/PowerFactor': 0.01,
+    '/Ac/ReactivePower': 0.5,
+    '/Ac/L1/ReactivePower': 0.5,
+    '/Ac/L2/ReactivePower': 0.5,
+    '/Ac/L3/ReactivePower': 0.5,
+    '/Ac/ApparentPower': 0.5,
+    '/Ac/L1/ApparentPower': 0.5,
+    '/Ac/L2/ApparentPower': 0.5,
+    '/Ac/L3/ApparentPower': 0.5,
+}
+
+# Everything published per frame: path, how it is derived from the measurements, unit and whether the path is
+# always there. 'value' is the measurement itself, 'net' the first minus the second (import minus export),
+# 'mean' the mean of the measurements the meter sends. Optional paths appear with the first frame that has all
+# their measurements, the Energy Meter for example has no frequency.
+PATHS = [
+    ('/Ac/Power', 'net', ('positive_active_demand', 'negative_active_demand'), 'W', True),
+    ('/Ac/Current', 'mean', ('current_L1', 'current_L2', 'current_L3'), 'A', True),
+    ('/Ac/Energy/Forward', 'value', ('positive_active_energy',), 'kWh', True),
+    ('/Ac/Energy/Reverse', 'value', ('negative_active_energy',), 'kWh', True),
+    ('/Ac/ReactivePower', 'net', ('positive_reactive_demand', 'negative_reactive_demand'), 'VAr', False),
+    ('/Ac/ApparentPower', 'net', ('positive_apparent_demand', 'negative_apparent_demand'), 'VA', False),
+    ('/Ac/PowerFactor', 'value', ('power_factor',), '', False),
+    ('/Ac/Frequency', 'value', ('frequency',), 'Hz', False),
+]
+for phase in ('L1', 'L2', 'L3'):
+    PATHS += [
+        (f'/Ac/{phase}/Voltage', 'value', (f'voltage_{phase}',), 'V', True),
+        (f'/Ac/{phase}/Current', 'value', (f'current_{phase}',), 'A', True),
+        (f'/Ac/{phase}/Power', 'net', (f'positive_active_demand_{phase}', f'negative_active_demand_{phase}'), 'W', True),
+        (f'/Ac/{phase}/Energy/Forward', 'value', (f'positive_active_energy_{phase}',), 'kWh', True),
+        (f'/Ac/{phase}/Energy/Reverse', 'value', (f'negative_active_energy_{phase}',), 'kWh', True),
+        (f'/Ac/{phase}/ReactivePower', 'net', (f'positive_reactive_demand_{phase}', f'negative_reactive_demand_{phase}'),
+         'VAr', False),
+        (f'/Ac/{phase}/ApparentPower', 'net', (f'positive_apparent_demand_{phase}', f'negative_apparent_demand_{phase}'),
+         'VA', False),
+        (f'/Ac/{phase}/PowerFactor', 'value', (f'power_factor_{phase}',), '', False),
+    ]
+UNITS = {path: unit for path, _, _, unit, _ in PATHS}
+
+# GetText format and divisor of every unit
+FORMATS = {
+    'W': ('%.1FW', 1),
+    'VAr': ('%.1FVAr', 1),
+    'VA': ('%.1FVA', 1),
+    'A': ('%.2FA', 1),
+    'V': ('%.2FV', 1),
+    'Hz': ('%.2FHz', 1),
+    'kWh': ('%.3FkWh', 1000),
+    '': ('%.3F', 1),
+}
+
+
+class Layout:
+    # PATHS compiled for the measurements of one frame layout into record indices, shared by all services
+    _cache = {}
+
+    def __init__(self, present):
+        index = Measurements.INDEX
+        self.paths = []
+        self.values, self.nets, self.means = [], [], []
+        for path, kind, measurements, unit, required in PATHS:
+            sent = [key for key in measurements if key in present]
+            if not required and len(sent) < len(measurements):
+                continue
+            self.paths.append(path)
+            if kind == 'value':
+                self.values.append((path, index[measurements[0]]))
+            elif kind == 'net':
+                self.nets.append((path, index[measurements[0]], index[measurements[1]]))
+            else:
+                indices = tuple(index[key] for key in sent or measurements[:1])
+                self.means.append((path, indices, len(indices)))
+
+    @classmethod
+    def get(cls, present):
+        layout = cls._cache.get(present)
+        if layout is None:
+            layout = cls._cache[present] = Layout(present)
+        return layout
+
+    def publish(self, data):
+        values = {path: data[i] for path, i in self.values}
+        for path, positive, negative in self.nets:
+            values[path] = data[positive] - data[negative]
+        for path, indices, count in self.means:
+            values[path] = round(sum([data[i] for i in indices]) / count, 3)
+        return values
+
+
+class CachedText:
+    # gettextcallback that formats each value once, GetText polls of an unchanged value return the cached string
+    __slots__ = ('format', 'divisor', 'cache')
+
+    def __init__(self, unit):
+        self.format, self.divisor = FORMATS[unit]
+        self.cache = {} # path -> (value, text)
+
+    def __call__(self, path, value):
+        cached = self.cache.get(path)
+        if cached is not None and cached[0] == value:
+            return cached[1]
+        text = self.format % (float(value) / self.divisor)
+        self.cache[path] = (value, text)
+        return text
+
+
+# With a publish interval these are averaged over the frames in between, power and current with min and max
+# under /Ac/Window, every other path is published with its latest value
+AVERAGED_PATHS = ('/Ac/Power', '/Ac/Current', '/Ac/L1/Power', '/Ac/L2/Power', '/Ac/L3/Power', '/Ac/L1/Current',
+                  '/Ac/L2/Current', '/Ac/L3/Current', '/Ac/L1/Voltage', '/Ac/L2/Voltage', '/Ac/L3/Voltage')
+EXTREME_PATHS = AVERAGED_PATHS[:8]
+
+# What a service publishes when its meter goes silent: zero power and current, hold the last values or /Connected = 0
+WATCHDOG_MODES = ('zero', 'hold', 'disconnect')
+WATCHDOG_TIMEOUT = 2.0 # seconds, until the frame period of the meter is known
+# Without a fixed timeout a meter is stale after this many frame periods without a frame, at least WATCHDOG_MIN
+# seconds: multicast over WiFi or a busy switch loses single frames, which must not toggle the power to 0
+WATCHDOG_PERIODS = 3
+WATCHDOG_MIN = 1.0
+ZERO_PATHS = ('/Ac/Power', '/Ac/Current', '/Ac/L1/Power', '/Ac/L2/Power', '/Ac/L3/Power', '/Ac/L1/Current',
+              '/Ac/L2/Current', '/Ac/L3/Current')
+
+# Last serial, firmware, role and values of every meter, for a warm start
+STATE_FILE = '/data/dbus-homemanager/state.json'
+STATE_INTERVAL = 900 # seconds between writes while nothing but the values changed, it lives on flash
+STATE_EXPIRY = 30 * 86400 # seconds, meters not heard for longer are dropped from the cache
+# A new meter waits this long after startup for the cached meters, then takes over the role and device
+# instance of one that has not been heard: the meter it replaced
+STATE_GRACE = 5
+
+# On-demand profiles of the running bridge, see Profiler
+PROFILE_DIR = '/data/dbus-homemanager'
+PROFILE_SECONDS = 30
+PROFILE_MAX = 3600 # seconds, longer profiles are refused
+PROFILE_INTERVAL = 0.005 # seconds of CPU time between samples
+
+STATS_INTERVAL = 10 # seconds between updates of the /Mgmt/Stats paths
+
+# The history ring of a meter holds --history hours at the frame rate measured from its ticker, with room
+# for frames that come in faster, up to HISTORY_MAX_RATE frames per second
+HISTORY_HEADROOM = 1.25
+HISTORY_MAX_RATE = 50
+STATS_COUNTERS = {
+    '/Mgmt/Stats/Frames/Accepted': 'accepted',
+    '/Mgmt/Stats/Frames/WrongHeader': 'wrong_header',
+    '/Mgmt/Stats/Frames/WrongProtocol': 'wrong_protocol',
+    '/Mgmt/Stats/Frames/WrongSerial': 'wrong_serial',
+    '/Mgmt/Stats/Frames/TooShort': 'too_short',
+    '/Mgmt/Stats/Frames/UnknownObis': 'unknown_obis',
+    '/Mgmt/Stats/Frames/Duplicates': 'duplicates',
+    '/Mgmt/Stats/Frames/Reordered': 'reordered',
+    '/Mgmt/Stats/Frames/Lost': 'lost',
+}
+STATS_STAGES = ('Select', 'Recv', 'Decode', 'Publish', 'EndToEnd')
+
+
+class DeltaPublisher:
+    # Writes only the paths whose value changed by more than their deadband. When vedbus supports it,
+    # all changes of one update go out as a single ItemsChanged signal instead of one PropertiesChanged per path.
+    def __init__(self, dbusservice, deadbands=None, report_interval=60):
+        self._dbusservice = dbusservice
+        self._deadbands = DEADBANDS if deadbands is None else deadbands
+        self._batched = hasattr(dbusservice, '__enter__')
+        self._published = {}
+        self._rules = {} # Layout -> its paths with their deadbands, see publish_record()
+        self._report_interval = report_interval
+        self._report_time = time.monotonic()
+
+        self.signals_sent = 0
+        self.signals_saved = 0
+        self.signals_saved_per_minute = 0
+        self._saved_since_report = 0
+
+    def seed(self, values):
+        # values that are on dbus already, e.g. the initial values of add_path
+        self._published.update(values)
+
+    def publish(self, values):
+        changes = []
+        for path, value in values.items():
+            last = self._published.get(path)
+            if last is not None and abs(value - last) <= self._deadbands.get(path, 0):
+                continue
+            changes.append((path, value))
+            self._published[path] = value
+
+        self._sent(changes, len(values))
+
+    def publish_record(self, layout, data):
+        # publish(layout.publish(data)) in one pass and without a dict per frame: every value is compared with
+        # its deadband right where it is computed
+        rules = self._rules.get(layout)
+        if rules is None:
+            deadbands = self._deadbands
+            rules = self._rules[layout] = (
+                [(path, i, deadbands.get(path, 0)) for path, i in layout.values],
+                [(path, positive, negative, deadbands.get(path, 0)) for path, positive, negative in layout.nets],
+                [(path, indices, count, deadbands.get(path, 0)) for path, indices, count in layout.means])
+        values, nets, means = rules
+        published, changes = self._published, []
+        for path, i, deadband in values:
+            value = data[i]
+            last = published.get(path)
+            if last is None or not abs(value - last) <= deadband:
+                changes.append((path, value))
+                published[path] = value
+        for path, positive, negative, deadband in nets:
+            value = data[positive] - data[negative]
+            last = published.get(path)
+            if last is None or not abs(value - last) <= deadband:
+                changes.append((path, value))
+                published[path] = value
+        for path, indices, count, deadband in means:
+            value = round(sum([data[i] for i in indices]) / count, 3)
+            last = published.get(path)
+            if last is None or not abs(value - last) <= deadband:
+                changes.append((path, value))
+                published[path] = value
+        self._sent(changes, len(layout.paths))
+
+    def _sent(self, changes, count):
+        sent = self.write(changes)
+        self.signals_sent += sent
+        self.signals_saved += count - sent
+        self._saved_since_report += count - sent
+        self._report()
+
+    def write(self, changes):
+        # writes (path, value) pairs as they are, returns the number of signals that went out
+        if changes and self._batched:
+            with self._dbusservice as service:
+                for path, value in changes:
+                    service[path] = value
+            return 1
+        for path, value in changes:
+            self._dbusservice[path] = value
+        return len(changes)
+
+    def _report(self):
+        now = time.monotonic()
+        if now - self._report_time < self._report_interval:
+            return
+        self.signals_saved_per_minute = round(self._saved_since_report * 60 / (now - self._report_time))
+        logging.info(f'Saved {self.signals_saved_per_minute} dbus signals per minute')
+        self._saved_since_report = 0
+        self._report_time = now
+
+
+class Window:
+    # Incremental aggregate of the values of all frames between two publishes
+    def __init__(self):
+        self.count = 0
+        self.latest = {}
+        self.sum = dict.fromkeys(AVERAGED_PATHS, 0.0)
+        self.min = {}
+        self.max = {}
+
+    def add(self, values):
+        self.latest = values
+        if not self.count:
+            self.sum.update((path, values[path]) for path in AVERAGED_PATHS)
+            self.min = {path: values[path] for path in EXTREME_PATHS}
+            self.max = dict(self.min)
+            self.count = 1
+            return
+        self.count += 1
+        total, minimum, maximum = self.sum, self.min, self.max
+        for path in AVERAGED_PATHS:
+            total[path] += values[path]
+        for path in EXTREME_PATHS:
+            value = values[path]
+            if value < minimum[path]:
+                minimum[path] = value
+            elif value > maximum[path]:
+                maximum[path] = value
+
+    def result(self):
+        values = dict(self.latest)
+        for path in AVERAGED_PATHS:
+            values[path] = self.sum[path] / self.count
+        for path in EXTREME_PATHS:
+            window = path.replace('/Ac', '/Ac/Window', 1)
+            values[f'{window}/Min'] = self.min[path]
+            values[f'{window}/Max'] = self.max[path]
+        return values
+
+    def clear(self):
+        self.count = 0
+
+
+class Watchdog:
+    # Deadline on the monotonic clock that every frame of the meter pushes out. A one-shot GLib timer checks
+    # it when it is due, so a silent meter is noticed right at the timeout, independent of the receive path
+    # and of wall clock jumps. Without a fixed timeout the limit follows the measured frame period:
+    # WATCHDOG_PERIODS periods, at least min_timeout.
+    def __init__(self, on_stale, on_recover, timeout=None, min_timeout=WATCHDOG_MIN):
+        self.on_stale = on_stale
+        self.on_recover = on_recover
+        self.timeout = timeout
+        self.min_timeout = min_timeout
+        self.period = None # average time between frames
+        self.last = None
+        self.stale = False
+        self.deadline = time.monotonic() + self.limit()
+        self._timer = None
+        self._arm()
+
+    def limit(self):
+        if self.timeout:
+            return self.timeout
+        if self.period is None:
+            return WATCHDOG_TIMEOUT
+        return max(self.min_timeout, WATCHDOG_PERIODS * self.period)
+
+    def feed(self):
+        now = time.monotonic()
+        if self.last is not None:
+            interval = now - self.last
+            self.period = interval if self.period is None else self.period + (interval - self.period) / 8
+        self.last = now
+        self.deadline = now + self.limit()
+        if self.stale:
+            self.stale = False
+            self.on_recover()
+            self._arm()
+
+    def close(self):
+        if self._timer is not None:
+            gobject.source_remove(self._timer)
+            self._timer = None
+
+    def _arm(self):
+        if self._timer is None:
+            self._timer = gobject.timeout_add(max(1, int((self.deadline - time.monotonic()) * 1000)), self._expire)
+
+    def _expire(self):
+        self._timer = None
+        if time.monotonic() < self.deadline:
+            self._arm() # frames came in since the timer was set
+        else:
+            self.stale = True
+            self.on_stale()
+        return False
+
+
+class StateCache:
+    # Small JSON file with one entry per serial, replaced atomically so a crash or power cut during a write
+    # leaves the previous state in place
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+        self.meters = {}
+        try:
+            with open(path) as f:
+                self.meters = {int(serial): entry for serial, entry in json.load(f).items()}
+            logging.info(f'Loaded the state of {len(self.meters)} meter(s) from {path}')
+            expired = time.time() - STATE_EXPIRY
+            for serial, entry in list(self.meters.items()):
+                if entry.get('heard', expired) < expired:
+                    logging.info(f'Dropping meter {serial} from the state cache, not heard since {time.ctime(entry["heard"])}')
+                    del self.meters[serial]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            logging.warning(f'Ignoring state file {path}: {e}')
+
+    def save(self):
+        temp = f'{self.path}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temp, 'w') as f:
+                json.dump(self.meters, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.path)
+        except OSError as e:
+            logging.warning(f'Could not write state file {self.path}: {e}')
+
+
+class Profiler:
+    # Sampling profiler for a bridge that uses too much CPU in the field: SIGUSR1 or a write of N seconds to
+    # /Mgmt/Profile samples the Python stack every PROFILE_INTERVAL of CPU time, main loop callbacks and the
+    # decode and publish path included, and writes the stacks in collapsed format (flamegraph.pl, speedscope)
+    # to directory. It switches itself off after N seconds, while off no timer or hook is installed.
+    def __init__(self, directory=PROFILE_DIR, interval=PROFILE_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.stacks = None # collapsed stack -> samples while running
+        self.seconds = 0
+        self.path = '' # the last profile written
+        self.listeners = [] # called with no arguments when profiling starts or stops
+
+    def _on_signal(self, *args):
+        self.start()
+        return True
+
+    def start(self, seconds=PROFILE_SECONDS):
+        # NaN fails both comparisons, inf and values beyond the milliseconds of a GLib timer the second
+        if self.stacks is not None or not 0 < seconds <= PROFILE_MAX:
+            return False
+        # the stop is scheduled first: sampling never starts without it
+        gobject.timeout_add(int(seconds * 1000), self.stop)
+        self.stacks = {}
+        self.seconds = seconds
+        self.started = time.process_time()
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        logging.info(f'Profiling for {seconds} s')
+        self._notify()
+        return True
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        stack = ';'.join(reversed(names))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN) # a sample still on its way must not end the process
+        stacks, self.stacks = self.stacks, None
+        path = os.path.join(self.directory, time.strftime('profile-%Y%m%d-%H%M%S.collapsed'))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, 'w') as f:
+                for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+                    f.write(f'{stack} {count}\n')
+            self.path = path
+            logging.info(f'Wrote {sum(stacks.values())} samples, {time.process_time() - self.started:.2f} s of CPU, to {path}')
+        except OSError as e:
+            logging.warning(f'Could not write profile {path}: {e}')
+        self.seconds = 0
+        self._notify()
+        return False
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener()
+
+
+def dbusservice(servicename, bus):
+    # The name is claimed by register() once every path is in place: clients see the service complete and
+    # adding a path does not emit anything. velib_python before the register argument claims it right away.
+    try:
+        return VeDbusService(servicename, bus, register=False), True
+    except TypeError:
+        return VeDbusService(servicename, bus), False
+
+
+def dbusconnection():
+    # every dbus service of this process needs a connection of its own
+    if 'DBUS_SESSION_BUS_ADDRESS' in os.environ:
+        return dbus.SessionBus(private=True)
+    return dbus.SystemBus(private=True)
 
 
 class DbusSmaService:
-    def __init__(self, servicename, deviceinstance, productname='Home Manager 2.0 dbus-bridge'):
-        self.home_manager = HomeManager20()
+    def __init__(self, servicename, deviceinstance, productname='Home Manager 2.0 dbus-bridge', event_driven=False, drain=False,
+                 deadbands=None, home_manager=None, capture=None, serial=None, bus=None, position=None, schedule=True,
+                 watchdog_timeout=None, watchdog_mode='zero', publish_interval=0, cached=None, profiler=None,
+                 watchdog_min=WATCHDOG_MIN):
+        self.home_manager = HomeManager20(drain=drain, capture=capture) if home_manager is None else home_manager
+        # Bound to one serial the service only publishes that meter, otherwise whatever frame was decoded last
+        self.serial = serial
 
-        # Read data from Home Manager once to get the serial number and firmware version
-        # if not self.home_manager._read_data(timeout=10):
-        #     logging.error('Could not read data from Home Manager, aborting startup')
-        #     sys.exit(1)
-        # self.home_manager._decode_data()
+        # No blocking read of a first frame: /Serial, /FirmwareVersion and the values come from the state cache
+        # right away and are reconciled with the first live frame
+        cached = cached or {}
+        self.role = servicename.split('.')[2]
+        self.deviceinstance = deviceinstance
+        self.heard = cached.get('heard') # wall clock time of the last frame of a meter not heard in this run
 
-        self._dbusservice = VeDbusService("{}.http_{:02d}".format(servicename, deviceinstance))
+        self.bus = bus
+        self._dbusservice, register = dbusservice("{}.http_{:02d}".format(servicename, deviceinstance), bus)
         logging.debug(f"{servicename} /DeviceInstance = {deviceinstance}")
 
         # Register management objects, see dbus-api for more information
         self._dbusservice.add_path('/Mgmt/ProcessName', productname)
         self._dbusservice.add_path('/Mgmt/ProcessVersion', VERSION)
         self._dbusservice.add_path('/Mgmt/Connection', f'TCP/IP multicast group {MCAST_GRP}')
+        # write N to profile the process for N seconds, see Profiler
+        self.profiler = profiler
+        if profiler is not None:
+            self._dbusservice.add_path('/Mgmt/Profile', profiler.seconds, writeable=True, onchangecallback=self._on_profile)
+            self._dbusservice.add_path('/Mgmt/ProfileFile', profiler.path)
+            profiler.listeners.append(self._on_profiler)
 
         # Register mandatory objects
         self._dbusservice.add_path('/DeviceInstance', deviceinstance)
         self._dbusservice.add_path('/ProductId', 45058)  # value used in ac_sensor_bridge.cpp of dbus-cgwacs
         self._dbusservice.add_path('/ProductName', productname)
-        # self._dbusservice.add_path('/FirmwareVersion', self.home_manager.hmdata['fw_version'])
+        self._dbusservice.add_path('/FirmwareVersion', cached.get('fw_version', ''))
         self._dbusservice.add_path('/HardwareVersion', 0)
         self._dbusservice.add_path('/Connected', 1)
-        # self._dbusservice.add_path('/Serial', self.home_manager.hmdata['serial'])
-        self._dbusservice.add_path('/Ac/Power', 0, gettextcallback=self._get_text_for_w)
-        self._dbusservice.add_path('/Ac/L1/Voltage', 0, gettextcallback=self._get_text_for_v)
-        self._dbusservice.add_path('/Ac/L2/Voltage', 0, gettextcallback=self._get_text_for_v)
-        self._dbusservice.add_path('/Ac/L3/Voltage', 0, gettextcallback=self._get_text_for_v)
-        self._dbusservice.add_path('/Ac/L1/Current', 0, gettextcallback=self._get_text_for_a)
-        self._dbusservice.add_path('/Ac/L2/Current', 0, gettextcallback=self._get_text_for_a)
-        self._dbusservice.add_path('/Ac/L3/Current', 0, gettextcallback=self._get_text_for_a)
-        self._dbusservice.add_path('/Ac/L1/Power', 0, gettextcallback=self._get_text_for_w)
-        self._dbusservice.add_path('/Ac/L2/Power', 0, gettextcallback=self._get_text_for_w)
-        self._dbusservice.add_path('/Ac/L3/Power', 0, gettextcallback=self._get_text_for_w)
-        self._dbusservice.add_path('/Ac/L1/Energy/Forward', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/L2/Energy/Forward', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/L3/Energy/Forward', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/L1/Energy/Reverse', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/L2/Energy/Reverse', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/L3/Energy/Reverse', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/Energy/Forward', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/Energy/Reverse', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/Current', 0, gettextcallback=self._get_text_for_a)
-
-        gobject.timeout_add(1000, self._update)
+        self._dbusservice.add_path('/Serial', str(cached.get('serial', serial or '')))
+        if position is not None:
+            self._dbusservice.add_path('/Position', position) # pvinverter only, 0 is AC input
+        self._texts = {unit: CachedText(unit) for unit in FORMATS}
+        # Energy counters and voltages of the last run are the initial values, power and current stay 0 until
+        # the meter is heard again
+        initial = {path: value for path, value in cached.get('values', {}).items() if path not in ZERO_PATHS}
+        for path, _, _, unit, required in PATHS:
+            if required:
+                self._dbusservice.add_path(path, initial.get(path, 0), gettextcallback=self._texts[unit])
+        initial = {path: value for path, value in initial.items() if path in self._dbusservice}
+        if publish_interval:
+            for path in EXTREME_PATHS:
+                gettext = self._texts[UNITS[path]]
+                window = path.replace('/Ac', '/Ac/Window', 1)
+                self._dbusservice.add_path(f'{window}/Min', 0, gettextcallback=gettext)
+                self._dbusservice.add_path(f'{window}/Max', 0, gettextcallback=gettext)
+
+        # Counters and per-stage latencies in us, p50/p99/max of everything since startup
+        for path in STATS_COUNTERS:
+            self._dbusservice.add_path(path, 0)
+        for path in ('/Mgmt/Stats/Frames/Coalesced', '/Mgmt/Stats/Frames/Dropped', '/Mgmt/Stats/Dbus/SignalsSent',
+                     '/Mgmt/Stats/Dbus/SignalsSaved', '/Mgmt/Stats/Relay/Subscribers', '/Mgmt/Stats/Relay/Dropped'):
+            self._dbusservice.add_path(path, 0)
+        for stage in STATS_STAGES:
+            for value in ('P50', 'P99', 'Max'):
+                self._dbusservice.add_path(f'/Mgmt/Stats/Latency/{stage}/{value}', 0)
+        # frames of this meter missing in its ticker sequence, and the jitter of their arrival in ms
+        self._dbusservice.add_path('/Mgmt/Stats/Meter/Lost', 0)
+        self._dbusservice.add_path('/Mgmt/Stats/Meter/Jitter', 0.0)
+        self._dbusservice.add_path('/Mgmt/Stats/Meter/JitterMax', 0.0)
+        # ms from startup until the cached and the first live values were on dbus
+        self._dbusservice.add_path('/Mgmt/Stats/Startup/Cached', round((time.monotonic() - STARTED) * 1000) if initial else None)
+        self._dbusservice.add_path('/Mgmt/Stats/Startup/Live', None)
+        if register:
+            self._dbusservice.register()
+
+        self._publisher = DeltaPublisher(self._dbusservice, deadbands)
+        self._publisher.seed(initial)
+        self.latency = 0.0
+        self.publish_time = Histogram()
+        self.end_to_end = Histogram()
+        self.log = RateLimitedLog()
+        self.watchdog_mode = watchdog_mode
+        self.watchdog = Watchdog(self._on_stale, self._on_recover, watchdog_timeout, watchdog_min)
+        self.live = False
+        self._layout = None
+        self._present = None
+        self.phases = cached.get('phases')
+        self._fw_version = None
+
+        # Every frame is aggregated, the window is published every publish_interval seconds
+        self.window = None
+        self._window_source = None
+        if publish_interval:
+            self.window = Window()
+            self._window_source = gobject.timeout_add(int(publish_interval * 1000), self._flush)
+
+        # DbusSmaBridge drives the services itself when several meters share the socket
+        if not schedule:
+            return
+        gobject.timeout_add_seconds(STATS_INTERVAL, self._publish_stats)
+        if event_driven:
+            # Decode and publish as soon as a datagram arrives
+            gobject.io_add_watch(self.home_manager.sock.fileno(), gobject.PRIORITY_DEFAULT, gobject.IO_IN, self._on_datagram)
+        else:
+            gobject.timeout_add(1000, self._update)
 
     def _update(self):
         if self.home_manager._read_data(timeout=1):
             self.home_manager._decode_data()
-        else:
-            if self.home_manager.last_update + 2 < time.time():
-                logging.error('No data received from Home Manager for 2 seconds, setting all values to zero')
-                self.home_manager.hmdata = {}
-            
-        if not self.home_manager.hmdata.get('serial', False):
-            print("No serial number found, aborting update")
+            if self.home_manager.updated:
+                self._publish()
+        return True
+
+    def _on_datagram(self, fd, condition):
+        if self.home_manager._recv_data():
+            self.home_manager._decode_data()
+            if self.home_manager.updated:
+                self._publish()
+        return True
+
+    def _meter(self):
+        return self.home_manager if self.serial is None else self.home_manager.meters[self.serial]
+
+    def _name(self):
+        return 'Home Manager' if self.serial is None else f'meter {self.serial}'
+
+    def _on_stale(self):
+        logging.error(f'No data received from {self._name()} for {self.watchdog.limit():.1f} s, '
+                      f'watchdog mode {self.watchdog_mode}')
+        if self.window is not None:
+            self.window.clear()
+        if self.watchdog_mode == 'zero':
+            self._publisher.publish(dict.fromkeys(ZERO_PATHS, 0))
+        elif self.watchdog_mode == 'disconnect':
+            self._dbusservice['/Connected'] = 0
+
+    def _on_recover(self):
+        logging.info(f'{self._name()} is sending again')
+        if self.watchdog_mode == 'disconnect':
+            self._dbusservice['/Connected'] = 1
+
+    def _publish(self):
+        start = time.perf_counter_ns()
+        meter = self._meter()
+        hmdata = meter.hmdata
+        if hmdata.serial is None:
+            self.log.log(logging.WARNING, 'serial', 'No serial number found, aborting update')
             return True
+        self.watchdog.feed()
+        if hmdata.fw_version is not self._fw_version or not self.live:
+            self._reconcile(hmdata)
 
-        with contextlib.suppress(KeyError):
-            # Check if the Home Manager is single phase or three phase
-            if self.home_manager.hmdata.get('current_L2', False) is False and self.home_manager.hmdata.get('current_L3', False) is False:
-                single_phase = True
-            else:
-                single_phase = False
-            
-            # Calculate the total current
-            if single_phase:
-                current = self.home_manager.hmdata.get('current_L1', 0)
-            else:
-                current = round((self.home_manager.hmdata.get('current_L1', 0) + self.home_manager.hmdata.get('current_L2', 0) +
-                                self.home_manager.hmdata.get('current_L3', 0)) / 3, 3)
-                
-            self._dbusservice['/Ac/Current'] = current
-            self._dbusservice['/Ac/Power'] = self.home_manager.hmdata.get('positive_active_demand', 0) - \
-                                             self.home_manager.hmdata.get('negative_active_demand', 0)
-            
-            self._dbusservice['/Ac/Energy/Forward'] = self.home_manager.hmdata.get('positive_active_energy', 0)
-            self._dbusservice['/Ac/Energy/Reverse'] = self.home_manager.hmdata.get('negative_active_energy', 0)
-
-
-            self._dbusservice['/Ac/L1/Voltage'] = self.home_manager.hmdata.get('voltage_L1', 0)
-            self._dbusservice['/Ac/L2/Voltage'] = self.home_manager.hmdata.get('voltage_L2', 0)
-            self._dbusservice['/Ac/L3/Voltage'] = self.home_manager.hmdata.get('voltage_L3', 0)
-            self._dbusservice['/Ac/L1/Current'] = self.home_manager.hmdata.get('current_L1', 0)
-            self._dbusservice['/Ac/L2/Current'] = self.home_manager.hmdata.get('current_L2', 0)
-            self._dbusservice['/Ac/L3/Current'] = self.home_manager.hmdata.get('current_L3', 0)
-
-            self._dbusservice['/Ac/L1/Power'] = self.home_manager.hmdata.get('positive_active_demand_L1', 0) - \
-                                                self.home_manager.hmdata.get('negative_active_demand_L1', 0)
-            self._dbusservice['/Ac/L2/Power'] = self.home_manager.hmdata.get('positive_active_demand_L2', 0) - \
-                                                self.home_manager.hmdata.get('negative_active_demand_L2', 0)
-            self._dbusservice['/Ac/L3/Power'] = self.home_manager.hmdata.get('positive_active_demand_L3', 0) - \
-                                                self.home_manager.hmdata.get('negative_active_demand_L3', 0)
-            
-            self._dbusservice['/Ac/L1/Energy/Forward'] = self.home_manager.hmdata.get('positive_active_energy_L1', 0)
-            self._dbusservice['/Ac/L2/Energy/Forward'] = self.home_manager.hmdata.get('positive_active_energy_L2', 0)
-            self._dbusservice['/Ac/L3/Energy/Forward'] = self.home_manager.hmdata.get('positive_active_energy_L3', 0)
-            self._dbusservice['/Ac/L1/Energy/Reverse'] = self.home_manager.hmdata.get('negative_active_energy_L1', 0)
-            self._dbusservice['/Ac/L2/Energy/Reverse'] = self.home_manager.hmdata.get('negative_active_energy_L2', 0)
-            self._dbusservice['/Ac/L3/Energy/Reverse'] = self.home_manager.hmdata.get('negative_active_energy_L3', 0)
+        if hmdata.present is not self._present:
+            self._adopt(hmdata.present)
+        if self.window is None:
+            self._publisher.publish_record(self._layout, hmdata.data)
+            self._published(meter)
+        else:
+            self.window.add(self._layout.publish(hmdata.data))
+        self.publish_time.record(time.perf_counter_ns() - start)
+        return True
+
+    def _adopt(self, present):
+        # a new frame layout, register the optional paths it brings along
+        self._present = present
+        self._layout = Layout.get(present)
+        for path in self._layout.paths:
+            if path not in self._dbusservice:
+                self._dbusservice.add_path(path, 0, gettextcallback=self._texts[UNITS[path]])
+
+    def _reconcile(self, hmdata):
+        # the first live frame or a firmware update replaces what the cache said
+        self._fw_version = hmdata.fw_version
+        self._dbusservice['/Serial'] = str(hmdata.serial)
+        self._dbusservice['/FirmwareVersion'] = hmdata.fw_version or ''
+        self.phases = 3 if 'current_L2' in hmdata or 'current_L3' in hmdata else 1
+        if not self.live:
+            self.live = True
+            startup = round((time.monotonic() - STARTED) * 1000)
+            self._dbusservice['/Mgmt/Stats/Startup/Live'] = startup
+            logging.info(f'First live frame of {self._name()} on dbus {startup} ms after startup')
+
+    def state(self):
+        # the entry of this meter in the state cache
+        return {'serial': self.serial or self._meter().hmdata.serial, 'fw_version': self._dbusservice['/FirmwareVersion'],
+                'phases': self.phases, 'role': self.role, 'instance': self.deviceinstance,
+                'heard': self._meter().last_update if self.live else self.heard, 'values': dict(self._publisher._published)}
+
+    def close(self):
+        # a cached meter that another meter replaced: its timers stop and its name goes off the bus
+        self.watchdog.close()
+        if self._window_source is not None:
+            gobject.source_remove(self._window_source)
+        if self.profiler is not None:
+            self.profiler.listeners.remove(self._on_profiler)
+        if self.bus is not None:
+            self.bus.close()
+
+    def _flush(self):
+        if self.window.count:
+            self._publisher.publish(self.window.result())
+            self._published(self._meter())
+            self.window.clear()
         return True
 
+    def _published(self, meter):
+        # from the moment the (last) frame arrived at the socket until it is on dbus
+        self.latency = time.time() - meter.rx_time
+        self.end_to_end.record(max(0, int(self.latency * 1e9)))
+
+    def _publish_stats(self):
+        stats = self.home_manager.stats
+        values = {path: getattr(stats, name) for path, name in STATS_COUNTERS.items()}
+        values['/Mgmt/Stats/Frames/Coalesced'] = self.home_manager.frames_coalesced
+        values['/Mgmt/Stats/Frames/Dropped'] = self.home_manager.frames_dropped
+        values['/Mgmt/Stats/Dbus/SignalsSent'] = self._publisher.signals_sent
+        values['/Mgmt/Stats/Dbus/SignalsSaved'] = self._publisher.signals_saved
+        values['/Mgmt/Stats/Relay/Subscribers'] = sum(len(relay.subscribers) for relay in self.home_manager.relays)
+        values['/Mgmt/Stats/Relay/Dropped'] = sum(relay.dropped for relay in self.home_manager.relays)
+        for stage, histogram in zip(STATS_STAGES, (stats.select, stats.recv, stats.decode, self.publish_time,
+                                                   self.end_to_end)):
+            values[f'/Mgmt/Stats/Latency/{stage}/P50'] = histogram.percentile(50)
+            values[f'/Mgmt/Stats/Latency/{stage}/P99'] = histogram.percentile(99)
+            values[f'/Mgmt/Stats/Latency/{stage}/Max'] = histogram.max
+        meters = self.home_manager.meters
+        meter = next(iter(meters.values()), None) if self.serial is None else meters.get(self.serial)
+        if meter is not None:
+            values['/Mgmt/Stats/Meter/Lost'] = meter.lost
+            values['/Mgmt/Stats/Meter/Jitter'] = round(meter.jitter, 2)
+            values['/Mgmt/Stats/Meter/JitterMax'] = round(meter.jitter_max, 2)
+
+        # without the deadbands and counters of the DeltaPublisher, its counters are part of the values
+        self._publisher.write(list(values.items()))
+        return True
+
+    def _on_profile(self, path, value):
+        try:
+            return self.profiler.start(float(value))
+        except (TypeError, ValueError, OverflowError):
+            return False
+
+    def _on_profiler(self):
+        self._dbusservice['/Mgmt/Profile'] = self.profiler.seconds
+        self._dbusservice['/Mgmt/ProfileFile'] = self.profiler.path
+
     def _handle_changed_value(self, value):
         logging.debug(f"Object {self} has been changed to {value}")
         return True
 
-    def _get_text_for_kwh(self, path, value):
-        return "%.3FkWh" % (float(value) / 1000.0)
 
-    def _get_text_for_w(self, path, value):
-        return "%.1FW" % (float(value))
+class DbusSmaBridge:
+    # One socket and decoder for all meters on the multicast group. Every serial gets its own dbus service,
+    # created when its first frame arrives, with the role and device instance from `meters` or assigned
+    # automatically: the first unmapped meter becomes the grid meter, further ones AC loads.
+    def __init__(self, meters=None, first_instance=40, event_driven=True, drain=True, deadbands=None, capture=None,
+                 socket_options=None, history_hours=0, history_socket=HISTORY_SOCKET, watchdog_timeout=None,
+                 watchdog_mode='zero', publish_interval=0, state_file=STATE_FILE, relays=None, archive=None,
+                 profile_dir=PROFILE_DIR, receiver_process=False, watchdog_min=WATCHDOG_MIN):
+        options = dict(drain=drain, capture=capture, relays=relays, **(socket_options or {}))
+        if receiver_process:
+            # Receiving and decoding run in a process of their own, a fresh interpreter, which serves the relays
+            # and the archive too and hands the frames over in shared memory
+            from homemanager_receiver import ReceiverProcess
+            self.archive = None
+            self.home_manager = ReceiverProcess(archive=archive, glib=gobject, **options)
+        else:
+            # Every decoded frame goes to the columnar archive too, written at least once a minute
+            self.archive = ArchiveWriter(archive) if archive else None
+            self.home_manager = HomeManager20(sinks=[self.archive] if self.archive else None, **options)
+            if self.archive:
+                gobject.timeout_add_seconds(60, self.archive.flush)
+            for relay in self.home_manager.relays:
+                gobject.io_add_watch(relay.fileno(), gobject.PRIORITY_DEFAULT, gobject.IO_IN, relay._on_connection)
+        self.meters = meters or {} # serial -> (role, device instance or None)
+        self.first_instance = first_instance
+        self.deadbands = deadbands
+        self.watchdog_timeout = watchdog_timeout
+        self.watchdog_mode = watchdog_mode
+        self.watchdog_min = watchdog_min
+        self.publish_interval = publish_interval
+        self.services = {}
+        self.assigned = {} # serial -> (role, device instance) of the running services
+
+        # kill -USR1 <pid> profiles the process for PROFILE_SECONDS
+        self.profiler = Profiler(profile_dir)
+        gobject.unix_signal_add(gobject.PRIORITY_HIGH, signal.SIGUSR1, self.profiler._on_signal)
+
+        # In-memory history of every meter, queried through a local unix socket
+        self.history_hours = history_hours
+        self.histories = {}
+        if history_hours:
+            self.history_server = HistoryServer(self.histories, history_socket, gobject)
+            gobject.io_add_watch(self.history_server.fileno(), gobject.PRIORITY_DEFAULT, gobject.IO_IN,
+                                 self.history_server._on_connection)
+
+        # Services of the meters of the last run are back on dbus before their first frame arrives
+        self.state = None
+        if state_file:
+            self.state = StateCache(state_file)
+            for serial, entry in self.state.meters.items():
+                self.services[serial] = self._create_service(serial, entry)
+            gobject.timeout_add_seconds(STATE_INTERVAL, self._save_state)
+
+        if event_driven:
+            gobject.io_add_watch(self.home_manager.sock.fileno(), gobject.PRIORITY_DEFAULT, gobject.IO_IN, self._on_datagram)
+        else:
+            gobject.timeout_add(1000, self._update)
+        gobject.timeout_add_seconds(STATS_INTERVAL, self._publish_stats)
+
+    def _update(self):
+        if self.home_manager._read_data(timeout=1):
+            self._publish()
+        return True
+
+    def close(self):
+        # on SIGTERM: the state cache, the tail of a capture and the archive rows still buffered
+        if self.state is not None:
+            self._save_state()
+        self.home_manager.close()
+        if self.history_hours:
+            self.history_server.close()
+
+    def _publish_stats(self):
+        for service in self.services.values():
+            service._publish_stats()
+        return True
+
+    def _on_datagram(self, fd, condition):
+        if self.home_manager._recv_data():
+            self._publish()
+        return True
+
+    def _publish(self):
+        # only the services of the meters in this batch of frames do any work
+        self.home_manager._decode_data()
+        for serial in self.home_manager.updated:
+            service = self.services.get(serial)
+            if service is None:
+                if self._unheard() and time.monotonic() < STARTED + STATE_GRACE:
+                    continue # a cached meter may still be on its way, the new one must not take over its role
+                service = self.services[serial] = self._create_service(serial)
+            live, fw_version = service.live, service._fw_version
+            service._publish()
+            if self.state is not None and (not live or service._fw_version is not fw_version):
+                self._save_state() # a new meter or firmware, not only new values
+            if self.history_hours:
+                self._record(serial)
+
+    def _record(self, serial):
+        history = self.histories.get(serial)
+        meter = self.home_manager.meters[serial]
+        if history is None:
+            if meter.period is None:
+                return # the frame rate of the meter is known from its second frame on
+            frame_rate = 1000 / meter.period * HISTORY_HEADROOM
+            if frame_rate > HISTORY_MAX_RATE:
+                logging.warning(f'Meter {serial} sends {1000 / meter.period:.0f} frames/s, the history keeps '
+                                f'{self.history_hours * HISTORY_MAX_RATE / frame_rate:.2f} hours of them')
+                frame_rate = HISTORY_MAX_RATE
+            history = self.histories[serial] = History(self.history_hours, frame_rate)
+        history.append(meter.rx_time, meter.hmdata)
 
-    def _get_text_for_v(self, path, value):
-        return "%.2FV" % (float(value))
+    def _unheard(self):
+        # the cached meters with an automatic role that have not sent a frame since startup
+        return [serial for serial, service in self.services.items() if not service.live and serial not in self.meters]
 
-    def _get_text_for_a(self, path, value):
-        return "%.2FA" % (float(value))
+    def _drop(self, serial):
+        self.services.pop(serial).close()
+        del self.assigned[serial]
+        if self.state is not None:
+            self.state.meters.pop(serial, None)
+
+    def _save_state(self):
+        self.state.meters.update((serial, service.state()) for serial, service in self.services.items())
+        self.state.save()
+        return True
+
+    def _create_service(self, serial, cached=None):
+        role, instance = self.meters.get(serial, (None, None))
+        if role is None and cached:
+            # the meter keeps its role and device instance across restarts
+            role = cached.get('role')
+            if instance is None and cached.get('instance') not in {instance for _, instance in self.meters.values()}:
+                instance = cached.get('instance')
+        if role is None:
+            unheard = self._unheard()
+            role = 'acload' if any(role == 'grid' for known, (role, _) in self.assigned.items() if known not in unheard) else 'grid'
+            # a meter that replaced a cached one takes over its role and device instance
+            replaced = next((known for known in unheard if self.assigned[known][0] == role), None)
+            if replaced is not None:
+                instance = self.assigned[replaced][1]
+                logging.info(f'Meter {serial} replaces meter {replaced}, which has not been heard since startup')
+                self._drop(replaced)
+        if instance is None:
+            used = {instance for _, instance in self.assigned.values()} | {instance for _, instance in self.meters.values()}
+            instance = self.first_instance
+            while instance in used:
+                instance += 1
+        self.assigned[serial] = (role, instance)
+
+        logging.info(f'Meter {serial}: role {role}, device instance {instance}')
+        service = DbusSmaService(f'{SERVICE_PREFIX}.{role}.{SERVICE_CONNECTION}', instance, home_manager=self.home_manager,
+                                 deadbands=self.deadbands, serial=serial, bus=dbusconnection(),
+                                 position=0 if role == 'pvinverter' else None, schedule=False,
+                                 watchdog_timeout=self.watchdog_timeout, watchdog_mode=self.watchdog_mode,
+                                 watchdog_min=self.watchdog_min, publish_interval=self.publish_interval, cached=cached, profiler=self.profiler)
+        return service
+
+
+def parse_meter(value):
+    # SERIAL:ROLE[:INSTANCE]
+    serial, role, *instance = value.split(':')
+    if role not in ROLES or len(instance) > 1:
+        raise argparse.ArgumentTypeError(f'expected SERIAL:ROLE[:INSTANCE] with ROLE one of {", ".join(ROLES)}')
+    return int(serial), (role, int(instance[0]) if instance else None)
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-    thread.daemon = True
+    parser = argparse.ArgumentParser(description='SMA Home Manager 2.0 dbus bridge')
+    parser.add_argument('--capture', metavar='FILE', help='append every received datagram to a capture file, '
+                                                         'replay it with homemanager_decoder.py --replay')
+    parser.add_argument('--meter', metavar='SERIAL:ROLE[:INSTANCE]', type=parse_meter, action='append', default=[],
+                        help=f'role ({", ".join(ROLES)}) and optional device instance of a meter, repeat for every meter')
+    parser.add_argument('--history', metavar='HOURS', type=float, default=0,
+                        help='keep the frames of the last HOURS in memory and answer queries with homemanager_history.py')
+    parser.add_argument('--history-socket', metavar='PATH', default=HISTORY_SOCKET, help=f'default {HISTORY_SOCKET}')
+    parser.add_argument('--archive', metavar='DIR', nargs='?', const=ARCHIVE_DIR,
+                        help=f'append every frame to a daily columnar archive, read it with homemanager_archive.py, default {ARCHIVE_DIR}')
+    parser.add_argument('--publish-interval', metavar='SECONDS', type=float, default=0,
+                        help='publish the mean, min and max of the frames in between every SECONDS, default every frame')
+    parser.add_argument('--watchdog-timeout', metavar='SECONDS', type=float,
+                        help=f'a meter is stale after this long without frames, default {WATCHDOG_PERIODS} frame periods')
+    parser.add_argument('--watchdog-min', metavar='SECONDS', type=float, default=WATCHDOG_MIN,
+                        help=f'the shortest timeout that follows the frame period, default {WATCHDOG_MIN}')
+    parser.add_argument('--watchdog-mode', choices=WATCHDOG_MODES, default='zero',
+                        help='on a stale meter publish zero power and current, hold the last values or set /Connected to 0')
+    parser.add_argument('--state', metavar='FILE', default=STATE_FILE,
+                        help=f'state cache for a warm start, default {STATE_FILE}, empty to disable')
+    parser.add_argument('--profile-dir', metavar='DIR', default=PROFILE_DIR,
+                        help=f'where SIGUSR1 and /Mgmt/Profile write their profiles, default {PROFILE_DIR}')
+    parser.add_argument('--receiver-process', action='store_true',
+                        help='receive and decode in a separate process, frames are handed over in shared memory')
+    parser.add_argument('--debug', action='store_true', help='log rejected frames and unknown OBIS ids')
+    add_socket_arguments(parser)
+    add_relay_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
     DBusGMainLoop(set_as_default=True)
-    DbusSmaService(servicename='com.victronenergy.grid.tcpip_239_12_255_254', deviceinstance=40)
+    bridge = DbusSmaBridge(meters=dict(args.meter), first_instance=40, event_driven=True, drain=True, capture=args.capture,
+                  socket_options=socket_options(args), history_hours=args.history, history_socket=args.history_socket,
+                  watchdog_timeout=args.watchdog_timeout, watchdog_mode=args.watchdog_mode, watchdog_min=args.watchdog_min,
+                  publish_interval=args.publish_interval, state_file=args.state, relays=relays(args), archive=args.archive,
+                  profile_dir=args.profile_dir, receiver_process=args.receiver_process)
     logging.info('Connected to dbus, switching over to gobject.MainLoop()')
+    # Keep the startup objects out of future collections, the receive path itself hardly allocates
+    gc.freeze()
     mainloop = gobject.MainLoop()
+    # daemontools stops the service with SIGTERM
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        gobject.unix_signal_add(gobject.PRIORITY_HIGH, signum, mainloop.quit)
     mainloop.run()
+    bridge.close()
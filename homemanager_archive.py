@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# Append-only columnar archive of the decoded frames, one directory per meter and UTC day.
+#
+# Every day directory holds schema.json, the header that names the columns and their types, and one file
+# per column: the receive time, a bit mask of the channels in the frame (bit i is Measurements.KEYS[i]) and
+# one double per measurement. A row is appended to every column file, so a column is a plain little-endian
+# array that numpy maps without parsing, a month of one measurement is 30 files of 8 bytes per frame:
+#   <directory>/<serial>/2024-05-01/schema.json, time.bin, mask.bin, positive_active_demand.bin, ...
+# ArchiveWriter is a sink of HomeManager20 and buffers a minute of rows before it writes, the flash of the GX
+# sees a few small appends per minute. decode_capture() turns a capture file into the same columns with
+# numpy, whole frame layouts at once instead of frame by frame.
+
+import argparse
+import array
+import json
+import logging
+import os
+import time
+
+from homemanager_decoder import (CAPTURE_MAGIC, CAPTURE_RECORD, CAPTURE_SESSION, DATA2_HEADER, OBIS_ID, SMA_TAG,
+                                 TAG_DATA2, TAG_GROUP, HomeManager20, Measurements, _channel_width)
+
+KEYS = Measurements.KEYS
+ARCHIVE_DIR = '/data/dbus-homemanager/archive'
+SCHEMA = 'schema.json'
+FORMAT = 'homemanager-archive'
+VERSION = 1
+COLUMNS = (('time', '<f8'), ('mask', '<u8')) + tuple((key, '<f8') for key in KEYS)
+FLUSH_ROWS = 60 # rows buffered per meter before they are written
+DAY = 86400
+# homemanager_decoder.HEADER as numpy fields, the usual layout of a frame up to the ticker
+HEADER_FIELDS = [('sma', '>u4'), ('group_length', '>u2'), ('group_tag', '>u2'), ('group', '>u4'), ('data_length', '>u2'),
+                 ('data_tag', '>u2'), ('protocol', '>u2'), ('susy', '>u2'), ('serial', '>u4'), ('ticker', '>u4')]
+CAPTURE_FIELDS = [('timestamp', '<u8'), ('size', '<u2')] # CAPTURE_RECORD
+
+# numpy is imported on first use: it is not part of Venus OS, only the readers and the batch decoder need
+# it, and importing it takes longer than starting the whole bridge
+numpy = None
+
+
+def day_name(timestamp):
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+
+def channel_mask(present):
+    return sum(1 << Measurements.INDEX[key] for key in present)
+
+
+def _column_path(path, name):
+    return os.path.join(path, f'{name}.bin')
+
+
+def open_day(directory, serial, timestamp):
+    # the directory of the day of timestamp, created with its schema on the first row
+    path = os.path.join(directory, str(serial), day_name(timestamp))
+    if not os.path.exists(os.path.join(path, SCHEMA)):
+        os.makedirs(path, exist_ok=True)
+        schema = {'format': FORMAT, 'version': VERSION, 'serial': serial, 'day': day_name(timestamp),
+                  'columns': [{'name': name, 'dtype': dtype} for name, dtype in COLUMNS], 'mask_keys': list(KEYS)}
+        tmp = os.path.join(path, SCHEMA + '.tmp')
+        with open(tmp, 'w') as file:
+            json.dump(schema, file, indent=1)
+        os.replace(tmp, os.path.join(path, SCHEMA))
+    return path
+
+
+def append_columns(path, columns):
+    # columns maps every column name to the bytes of its new rows. The time column goes last: a row is
+    # complete once its time is written, a reader never trusts more rows than the shortest column has.
+    for name, _ in COLUMNS[1:] + COLUMNS[:1]:
+        with open(_column_path(path, name), 'ab') as file:
+            file.write(columns[name])
+
+
+class DayBuffer:
+    # Rows of one meter and day that are not written yet, row-major like the records of the decoder
+    __slots__ = ('serial', 'start', 'end', 'times', 'masks', 'rows')
+
+    def __init__(self, serial, timestamp):
+        self.serial = serial
+        self.start = timestamp // DAY * DAY
+        self.end = self.start + DAY
+        self.times = array.array('d')
+        self.masks = array.array('Q')
+        self.rows = array.array('d')
+
+
+class ArchiveWriter:
+    # Sink of HomeManager20 (see its sinks argument): publish() is called with every decoded frame
+    def __init__(self, directory=ARCHIVE_DIR, flush_rows=FLUSH_ROWS):
+        self.directory = directory
+        self.flush_rows = flush_rows
+        self.buffers = {} # serial -> DayBuffer
+        self.masks = {} # channels of a frame layout -> bit mask
+        self.rows = 0 # written so far
+        logging.info(f'Archiving frames to {directory}')
+
+    def publish(self, meter):
+        record = meter.hmdata
+        buffer = self.buffers.get(meter.serial)
+        if buffer is None or not buffer.start <= meter.rx_time < buffer.end:
+            if buffer is not None:
+                self._write(buffer)
+            buffer = self.buffers[meter.serial] = DayBuffer(meter.serial, meter.rx_time)
+        mask = self.masks.get(record.present)
+        if mask is None:
+            mask = self.masks[record.present] = channel_mask(record.present)
+        buffer.times.append(meter.rx_time)
+        buffer.masks.append(mask)
+        buffer.rows.extend(record.data)
+        if len(buffer.times) >= self.flush_rows:
+            self._write(buffer)
+
+    def _write(self, buffer):
+        if not buffer.times:
+            return
+        width = len(KEYS)
+        columns = {'time': buffer.times, 'mask': buffer.masks}
+        for i, key in enumerate(KEYS):
+            columns[key] = buffer.rows[i::width]
+        try:
+            append_columns(open_day(self.directory, buffer.serial, buffer.start), columns)
+            self.rows += len(buffer.times)
+        except OSError as e:
+            logging.error(f'Cannot archive {len(buffer.times)} frames of meter {buffer.serial}: {e}')
+        del buffer.times[:], buffer.masks[:], buffer.rows[:]
+
+    def flush(self):
+        for buffer in self.buffers.values():
+            self._write(buffer)
+        return True
+
+    close = flush
+
+
+def _require_numpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError('reading the archive and decoding captures in batches needs numpy') from None
+
+
+class ArchiveReader:
+    # Memory-maps the column files, slices of the arrays read only the pages they cover
+    def __init__(self, directory=ARCHIVE_DIR):
+        _require_numpy()
+        self.directory = directory
+
+    def meters(self):
+        return sorted(int(name) for name in os.listdir(self.directory) if name.isdigit())
+
+    def days(self, serial):
+        path = os.path.join(self.directory, str(serial))
+        return sorted(name for name in os.listdir(path) if os.path.exists(os.path.join(path, name, SCHEMA)))
+
+    def day(self, serial, day, keys=None):
+        # {column name: array} of one day, keys selects the measurements, time and mask are always there
+        path = os.path.join(self.directory, str(serial), day)
+        with open(os.path.join(path, SCHEMA)) as file:
+            schema = json.load(file)
+        if schema.get('format') != FORMAT or schema.get('version') != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} archive')
+        wanted = None if keys is None else {'time', 'mask', *keys}
+        columns = {}
+        for column in schema['columns']:
+            name = column['name']
+            if wanted is not None and name not in wanted:
+                continue
+            file = _column_path(path, name)
+            # a row cut off by a crash is ignored, as is a column that has no rows yet
+            rows = os.path.getsize(file) // numpy.dtype(column['dtype']).itemsize if os.path.exists(file) else 0
+            if rows:
+                columns[name] = numpy.memmap(file, column['dtype'], mode='r', shape=(rows,))
+            else:
+                columns[name] = numpy.empty(0, column['dtype'])
+        missing = wanted - columns.keys() if wanted is not None else ()
+        if missing:
+            raise KeyError(f'no column {", ".join(sorted(missing))} in {path}')
+        rows = min(len(values) for values in columns.values())
+        return {name: values[:rows] for name, values in columns.items()}
+
+    def read(self, serial, start, end, keys=None):
+        # the rows with start <= time < end over as many days as that takes. Within one day the arrays are
+        # views of the mapped files, over more days they are concatenated.
+        first, last = day_name(start), day_name(end)
+        parts = []
+        for day in self.days(serial):
+            if first <= day <= last:
+                columns = self.day(serial, day, keys)
+                times = columns['time']
+                lo, hi = numpy.searchsorted(times, start), numpy.searchsorted(times, end)
+                if hi > lo:
+                    parts.append({name: values[lo:hi] for name, values in columns.items()})
+        if len(parts) == 1:
+            return parts[0]
+        names = parts[0].keys() if parts else ['time', 'mask', *(KEYS if keys is None else keys)]
+        return {name: numpy.concatenate([part[name] for part in parts]) if parts else numpy.empty(0)
+                for name in names}
+
+
+def _capture_index(blob):
+    # offsets, sizes and receive times of the datagrams of a capture, see homemanager_decoder.read_capture.
+    # The records have to be walked one by one, the loop only collects the offsets and the sessions, sizes
+    # and times are read from the record headers at once.
+    if blob[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+        raise ValueError('not a capture file')
+    offsets = array.array('q')
+    sessions = array.array('q', [0]) # offsets of the session records, the first session starts at 0
+    session_ns, session_time = array.array('q', [0]), array.array('d', [0.0])
+    unpack, record = CAPTURE_RECORD.unpack_from, CAPTURE_RECORD.size
+    end = len(blob)
+    i = len(CAPTURE_MAGIC)
+    while i + record <= end:
+        timestamp_ns, size = unpack(blob, i)
+        i += record
+        if size == 0:
+            sessions.append(i)
+            session_ns.append(timestamp_ns)
+            session_time.append(CAPTURE_SESSION.unpack_from(blob, i)[0])
+            i += CAPTURE_SESSION.size
+        elif i + size > end: # capture cut off while writing
+            break
+        else:
+            offsets.append(i)
+            i += size
+    offsets = numpy.frombuffer(offsets, 'i8')
+    records = _fields(blob, offsets - record, numpy.dtype(CAPTURE_FIELDS))
+    session = numpy.searchsorted(numpy.frombuffer(sessions, 'i8'), offsets) - 1
+    times = (numpy.frombuffer(session_time)[session] +
+             (records['timestamp'].astype('i8') - numpy.frombuffer(session_ns, 'i8')[session]) / 1e9)
+    return offsets, records['size'].astype('i8'), times
+
+
+def _layout(datagram, start, end):
+    # (OBIS id, offset of the id, key, offset of the value, numpy type, scale) of the known channels between
+    # start and end, the walk of HomeManager20._build_plan
+    channels = []
+    i = start
+    while i + 4 <= end:
+        obis = OBIS_ID.unpack_from(datagram, i)[0]
+        decoder = HomeManager20.OBIS_DECODERS.get(obis)
+        if decoder is None:
+            width = _channel_width(obis)
+            if width is None or i + 4 + width > end:
+                break
+            i += 4 + width
+            continue
+        key, value_struct, scale = decoder
+        if i + 4 + value_struct.size > end:
+            break
+        if key != 'fw_version':
+            channels.append((obis, i, key, i + 4, f'>u{value_struct.size}', scale))
+        i += 4 + value_struct.size
+    return channels
+
+
+def _gather(blob, offsets, size):
+    # the frames at offsets cut to the same size and packed one after the other
+    return b''.join([blob[offset:offset + size] for offset in offsets.tolist()])
+
+
+def _fields(blob, offsets, dtype):
+    # the record of dtype at every offset, gathered by numpy, for small records that is faster than _gather
+    data = numpy.frombuffer(blob, numpy.uint8)
+    return data[offsets[:, None] + numpy.arange(dtype.itemsize)].view(dtype)[:, 0]
+
+
+def _strided(frames, offset, dtype):
+    # one field of every frame in the (frames, size) byte matrix as a view, without copying
+    return numpy.ndarray((len(frames),), dtype, frames, offset, (frames.strides[0],))
+
+
+def decode_capture(path):
+    # Decodes a whole capture with numpy: the frames are grouped by layout, every group becomes a byte
+    # matrix and every channel a strided view into it. Headers of the usual layout are checked for all
+    # frames at once, only the others go through HomeManager20._check_header one by one.
+    # Returns {serial: {column name: array}} with the rows ordered by receive time, repeated tickers of a
+    # meter (the same frame received twice) dropped like HomeManager20 drops them.
+    _require_numpy()
+    with open(path, 'rb') as file:
+        blob = file.read()
+    offsets, sizes, times = _capture_index(blob)
+
+    header = numpy.dtype(HEADER_FIELDS)
+    headers = numpy.zeros(len(offsets), header)
+    long = sizes >= header.itemsize
+    headers[long] = _fields(blob, offsets[long], header)
+    valid = (long & (headers['sma'] == SMA_TAG) & (headers['group_tag'] == TAG_GROUP) & (headers['group_length'] == 4) &
+             (headers['data_tag'] == TAG_DATA2) & (16 + headers['data_length'].astype('i8') <= sizes) &
+             (headers['protocol'] == 0x6069) & (headers['serial'] != 0xffffffff))
+    serials, tickers = headers['serial'], headers['ticker']
+    starts = numpy.full(len(offsets), 16 + DATA2_HEADER.size)
+    ends = 16 + headers['data_length'].astype('i8')
+
+    home_manager = HomeManager20(connect=False)
+    view = memoryview(blob)
+    for i in numpy.flatnonzero(~valid):
+        serial = home_manager._check_header(view[offsets[i]:offsets[i] + sizes[i]])
+        if serial is not None:
+            valid[i] = True
+            serials[i], tickers[i] = serial, home_manager.ticker
+            starts[i], ends[i] = home_manager.channels_start, home_manager.channels_end
+
+    parts = {} # serial -> list of column dicts
+    # frame size, start and end of the channels in one number, all of them are below 2 ** 16
+    layouts, group = numpy.unique((sizes << 32 | starts << 16 | ends)[valid], return_inverse=True)
+    offsets, times, serials, tickers = offsets[valid], times[valid], serials[valid], tickers[valid]
+    for n, layout in enumerate(layouts.tolist()):
+        size, channels_start, channels_end = layout >> 32, layout >> 16 & 0xffff, layout & 0xffff
+        rows = numpy.flatnonzero(group == n)
+        frames = numpy.frombuffer(_gather(blob, offsets[rows], size), numpy.uint8).reshape(len(rows), size)
+        while len(frames):
+            # the first frame is the template, frames with other OBIS ids at the same positions go round again
+            channels = _layout(frames[0].tobytes(), channels_start, channels_end)
+            match = numpy.ones(len(frames), bool)
+            for obis, id_offset, *_ in channels:
+                match &= _strided(frames, id_offset, '>u4') == obis
+            matched = frames[match]
+            columns = {'time': times[rows[match]], 'serial': serials[rows[match]], 'ticker': tickers[rows[match]]}
+            present = []
+            for _, _, key, value_offset, dtype, scale in channels:
+                columns[key] = _strided(matched, value_offset, dtype) / scale
+                present.append(key)
+            columns['mask'] = numpy.full(len(matched), channel_mask(present), numpy.uint64)
+            for serial in numpy.unique(columns['serial']):
+                select = columns['serial'] == serial
+                parts.setdefault(int(serial), []).append({name: values[select] for name, values in columns.items()})
+            frames, rows = frames[~match], rows[~match]
+
+    meters = {}
+    for serial, pieces in parts.items():
+        columns = {name: numpy.concatenate([piece.get(name, numpy.zeros(len(piece['time']), dtype)) for piece in pieces])
+                   for name, dtype in COLUMNS}
+        tickers = numpy.concatenate([piece['ticker'] for piece in pieces])
+        order = numpy.argsort(columns['time'], kind='stable')
+        tickers = tickers[order]
+        keep = numpy.ones(len(order), bool)
+        keep[1:] = tickers[1:] != tickers[:-1]
+        meters[serial] = {name: values[order][keep] for name, values in columns.items()}
+    return meters
+
+
+def convert_capture(path, directory=ARCHIVE_DIR):
+    # appends the frames of a capture to the archive, returns the number of rows written
+    rows = 0
+    for serial, columns in decode_capture(path).items():
+        days = columns['time'] // DAY
+        bounds = numpy.flatnonzero(numpy.diff(days)) + 1
+        for lo, hi in zip([0, *bounds], [*bounds, len(days)]):
+            day = open_day(directory, serial, columns['time'][lo])
+            append_columns(day, {name: numpy.ascontiguousarray(columns[name][lo:hi], dtype).tobytes()
+                                 for name, dtype in COLUMNS})
+            rows += hi - lo
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Columnar archive of the Home Manager frames')
+    parser.add_argument('--archive', metavar='DIR', default=ARCHIVE_DIR, help=f'default {ARCHIVE_DIR}')
+    commands = parser.add_subparsers(dest='command', required=True)
+    convert = commands.add_parser('convert', help='append the frames of capture files to the archive')
+    convert.add_argument('captures', metavar='CAPTURE', nargs='+')
+    summary = commands.add_parser('summary', help='min, mean and max of a measurement')
+    summary.add_argument('key', nargs='?', default='positive_active_demand')
+    summary.add_argument('--days', type=float, default=1, help='window ending now, default 1')
+    summary.add_argument('--serial', type=int, help='meter, needed when there is more than one')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'convert':
+        for capture in args.captures:
+            start = time.perf_counter()
+            rows = convert_capture(capture, args.archive)
+            print(f'{capture}: {rows} frames in {time.perf_counter() - start:.2f} s')
+    else:
+        reader = ArchiveReader(args.archive)
+        serial = args.serial if args.serial is not None else reader.meters()[0]
+        end = time.time()
+        columns = reader.read(serial, end - args.days * DAY, end, [args.key])
+        values = columns[args.key][(columns['mask'] >> numpy.uint64(KEYS.index(args.key)) & numpy.uint64(1)) == 1]
+        if not len(values):
+            print(f'no {args.key} of meter {serial} in the last {args.days} days')
+        else:
+            print(f'{serial} {args.key}: min {values.min()} mean {values.mean()} max {values.max()} '
+                  f'over {len(values)} frames')
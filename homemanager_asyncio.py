@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Asyncio receiver for hosts without GLib and Victron dbus, built on the decoder of HomeManager20.
+#
+# A DatagramProtocol on the multicast socket feeds every datagram to HomeManager20, which checks, sequences
+# and decodes it as in the bridge. Every decoded frame is copied once into a Frame and offered to the sinks.
+# A sink is any object with publish(frame), a plain function or a coroutine: CallbackSink, JsonLinesSink,
+# RelaySink (the local socket of FrameRelay) and homemanager_archive.ArchiveWriter all fit, a Frame looks
+# like the meter state HomeManager20 passes to its own sinks. Every sink has a bounded queue and a task of
+# its own, a sink that falls behind loses its oldest frames and never holds up the receiver or the others.
+# One event loop serves all meters on the group and all sinks, without threads.
+#
+#   python3 homemanager_asyncio.py --print --json /tmp/frames.jsonl --relay
+
+import argparse
+import asyncio
+import collections
+import inspect
+import json
+import logging
+
+from homemanager_decoder import (RELAY_SOCKET, FrameRelay, HomeManager20, Measurements, RateLimitedLog,
+                                 add_socket_arguments, socket_options)
+
+SINK_QUEUE = 64 # frames buffered per sink before its oldest ones are dropped
+
+
+class Frame:
+    # Snapshot of a decoded frame, the record of the decoder is overwritten by the next frame of the meter.
+    # serial, rx_time and hmdata are what the sinks of HomeManager20 read from its MeterState.
+    __slots__ = ('serial', 'rx_time', 'hmdata')
+
+    def __init__(self, meter):
+        record = meter.hmdata
+        self.serial = meter.serial
+        self.rx_time = meter.rx_time
+        self.hmdata = copy = Measurements.__new__(Measurements)
+        copy.data = record.data[:]
+        copy.channels, copy.present, copy.serial = record.channels, record.present, record.serial
+        copy.fw, copy.fw_version = record.fw, record.fw_version
+
+    def as_dict(self):
+        return {'serial': self.serial, 'time': self.rx_time, 'fw_version': self.hmdata.fw_version,
+                'values': dict(self.hmdata)}
+
+
+class CallbackSink:
+    # calls a function or awaits a coroutine function with every frame
+    def __init__(self, callback):
+        self.callback = callback
+
+    def publish(self, frame):
+        return self.callback(frame)
+
+
+class JsonLinesSink:
+    # appends one JSON object per frame to a file, flushed every flush_lines frames
+    def __init__(self, path, flush_lines=1):
+        self.file = open(path, 'a')
+        self.flush_lines = flush_lines
+        self.lines = 0
+
+    def publish(self, frame):
+        self.file.write(json.dumps(frame.as_dict()) + '\n')
+        self.lines += 1
+        if self.lines % self.flush_lines == 0:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class RelaySink:
+    # FrameRelay on the event loop: subscribers are accepted by a reader callback, publishing never blocks
+    def __init__(self, path=RELAY_SOCKET, json_lines=False):
+        self.relay = FrameRelay(path, json_lines)
+
+    def start(self, loop):
+        loop.add_reader(self.relay.fileno(), self.relay._on_connection)
+
+    def publish(self, frame):
+        self.relay.publish(frame)
+
+    def close(self):
+        self.relay.close()
+
+
+class SinkWorker:
+    # The bounded queue and the task of one sink. serials limits the sink to some meters.
+    def __init__(self, sink, queue=SINK_QUEUE, serials=None):
+        self.sink = sink
+        self.queue = collections.deque()
+        self.limit = queue
+        self.serials = None if serials is None else set(serials)
+        self.ready = asyncio.Event()
+        self.delivered = 0
+        self.dropped = 0
+        self.failed = 0
+        self.log = RateLimitedLog()
+        self.name = type(sink).__name__
+        self.task = None
+
+    def offer(self, frame):
+        if self.serials is not None and frame.serial not in self.serials:
+            return
+        if len(self.queue) >= self.limit:
+            self.queue.popleft()
+            self.dropped += 1
+            self.log.log(logging.WARNING, 'slow', f'{self.name} too slow, dropping frames')
+        self.queue.append(frame)
+        self.ready.set()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue:
+                frame = self.queue.popleft()
+                try:
+                    result = self.sink.publish(frame)
+                    if inspect.isawaitable(result):
+                        await result
+                    self.delivered += 1
+                except Exception as e:
+                    self.failed += 1
+                    self.log.log(logging.ERROR, 'failed', f'{self.name} failed: {e}')
+                # a synchronous sink must not starve the receiver while a backlog is worked off
+                await asyncio.sleep(0)
+
+
+class HomeManagerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    def datagram_received(self, data, addr):
+        self.receiver._on_datagram(data)
+
+    def error_received(self, exc):
+        logging.warning(f'Receive error: {exc}')
+
+
+class AsyncReceiver:
+    # Decodes the frames of every meter on the multicast group and passes them to the sinks. home_manager
+    # is created with the socket options of HomeManager20 when not given, and its socket is handed over to
+    # the event loop. Frames can also be fed directly with _on_datagram, e.g. from a capture.
+    def __init__(self, sinks=(), home_manager=None, queue=SINK_QUEUE, **options):
+        if home_manager is None:
+            # the transport reads with recvfrom, kernel timestamps would only cost
+            home_manager = HomeManager20(**{**options, 'timestamps': False})
+        self.home_manager = home_manager
+        self.workers = [sink if isinstance(sink, SinkWorker) else SinkWorker(sink, queue) for sink in sinks]
+        self.transport = None
+        self.frames = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            if hasattr(worker.sink, 'start'):
+                worker.sink.start(loop)
+            worker.task = loop.create_task(worker.run())
+        if self.home_manager.sock is not None:
+            self.transport, _ = await loop.create_datagram_endpoint(lambda: HomeManagerProtocol(self),
+                                                                    sock=self.home_manager.sock)
+
+    def _on_datagram(self, data, timestamp=None):
+        home_manager = self.home_manager
+        home_manager.datagram = home_manager.buffer.load(data, timestamp)
+        home_manager._decode_data()
+        for serial in home_manager.updated:
+            frame = Frame(home_manager.meters[serial])
+            self.frames += 1
+            for worker in self.workers:
+                worker.offer(frame)
+
+    async def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        for worker in self.workers:
+            if worker.task is not None:
+                worker.task.cancel()
+            if hasattr(worker.sink, 'close'):
+                worker.sink.close()
+
+    def stats(self):
+        return {'frames': self.frames, 'accepted': self.home_manager.stats.accepted,
+                'sinks': [{'sink': worker.name, 'delivered': worker.delivered, 'dropped': worker.dropped,
+                           'failed': worker.failed, 'queued': len(worker.queue)} for worker in self.workers]}
+
+
+async def main(args):
+    sinks = []
+    if args.print:
+        sinks.append(CallbackSink(lambda frame: print(frame.serial, frame.hmdata)))
+    if args.json:
+        sinks.append(JsonLinesSink(args.json))
+    if args.relay:
+        sinks.append(RelaySink(args.relay))
+    if args.archive:
+        from homemanager_archive import ArchiveWriter
+        sinks.append(ArchiveWriter(args.archive))
+    receiver = AsyncReceiver(sinks, queue=args.queue, **socket_options(args))
+    await receiver.start()
+    try:
+        while True:
+            await asyncio.sleep(60)
+            logging.info(f'{receiver.stats()}')
+    finally:
+        await receiver.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Decode SMA Home Manager 2.0 / Energy Meter frames on an asyncio event loop')
+    parser.add_argument('--print', action='store_true', help='print every frame')
+    parser.add_argument('--json', metavar='FILE', help='append every frame as a JSON line to FILE')
+    parser.add_argument('--relay', metavar='SOCKET', nargs='?', const=RELAY_SOCKET,
+                        help=f'relay every frame as a binary record on a local socket, default {RELAY_SOCKET}')
+    parser.add_argument('--archive', metavar='DIR', help='append every frame to a columnar archive')
+    parser.add_argument('--queue', type=int, default=SINK_QUEUE, help=f'frames buffered per sink, default {SINK_QUEUE}')
+    parser.add_argument('--debug', action='store_true', help='log rejected frames and unknown OBIS ids')
+    add_socket_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -1,6 +1,16 @@
+import argparse
+import array
+import atexit
+import collections
+import collections.abc
+import fcntl
+import json
+import operator
 import select
 import struct
 import logging
+import os
+import signal
 import socket
 import sys
 import time
@@ -8,6 +18,303 @@ import time
 MCAST_GRP = '239.12.255.254'
 MCAST_PORT = 9522
 
+# Speedwire: 'SMA\0', then tags of 2 bytes length and 2 bytes tag id. The usual frame has the group tag
+# followed by the data2 tag, whose data starts with protocol id, SUSy id, serial and ticker and is followed by
+# the OBIS channels. Those have 4 bytes id (channel, index, type, tariff) and a value of 4 or 8 bytes.
+OBIS_ID = struct.Struct('>I')
+TAG = struct.Struct('>HH')
+DATA2_HEADER = struct.Struct('>HHII') # protocol id, SUSy id, serial, ticker
+HEADER = struct.Struct('>IHHIHHHHII') # the usual layout: 'SMA\0', group tag, data2 tag, protocol id, SUSy id, serial, ticker
+# ms, how far the ticker of a meter may move against the receive times before it counts as restarted: a
+# reordered frame is a little behind the newest one and arrives right after it
+TICKER_SLACK = 1000
+RELAY_SOCKET = '/tmp/homemanager-relay.sock'
+RELAY_MAGIC = b'HMR1'
+RELAY_QUEUE = 16 # frames buffered per subscriber before its oldest ones are dropped
+
+PAD = (0,) # appended to the unpacked values for the channels a frame does not have
+SMA_TAG = 0x534d4100
+TAG_END = 0x0000
+TAG_GROUP = 0x02a0
+TAG_DATA2 = 0x0010
+CHANNEL_VERSION = 0x90
+DATAGRAM_SIZE = 1500 # one ethernet MTU, frames of newer firmware carry more channels than the 608 bytes of the HM 2.0
+
+# Capture file: magic, then per datagram a record of the monotonic receive time in ns and the size followed by
+# the raw datagram. A record with size 0 starts a session and is followed by the wall clock time of that moment.
+CAPTURE_MAGIC = b'SMACAP01'
+CAPTURE_RECORD = struct.Struct('<QH')
+CAPTURE_SESSION = struct.Struct('<d')
+
+# Linux values, not every Python build exports them
+IP_ADD_SOURCE_MEMBERSHIP = getattr(socket, 'IP_ADD_SOURCE_MEMBERSHIP', 39)
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SIOCGIFADDR = 0x8915
+TIMESPEC = struct.Struct('@ll')
+TIMESTAMP_ANCBUFSIZE = socket.CMSG_SPACE(TIMESPEC.size)
+
+
+class RateLimitedLog:
+    # At most one message per key and interval, with the number of messages suppressed in between.
+    # Nothing is formatted when the level is disabled, so disabled debug output costs one level check.
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.last = {}
+        self.suppressed = {}
+
+    def log(self, level, key, msg, *args):
+        if not logging.root.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        last = self.last.get(key)
+        if last is not None and now - last < self.interval:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return
+        self.last[key] = now
+        suppressed = self.suppressed.pop(key, 0)
+        if suppressed:
+            msg += f' ({suppressed} more since the last message)'
+        logging.log(level, msg, *args)
+
+
+class Histogram:
+    # Latency histogram with power of two buckets in microseconds, recording costs a few integer operations
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self, size=24):
+        self.buckets = [0] * size
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        us = ns // 1000
+        self.buckets[min(us.bit_length(), len(self.buckets) - 1)] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, percent):
+        # upper bound in us of the bucket holding the percentile
+        target = self.count * percent / 100
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min((1 << i) - 1, self.max)
+        return 0
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+
+class DecoderStats:
+    # Accept/reject counters and per-stage timing of HomeManager20
+    __slots__ = ('accepted', 'wrong_header', 'wrong_protocol', 'wrong_serial', 'too_short', 'unknown_obis',
+                 'duplicates', 'reordered', 'lost', 'select', 'recv', 'decode')
+
+    REJECTS = ('wrong_header', 'wrong_protocol', 'wrong_serial', 'too_short')
+
+    def __init__(self):
+        self.accepted = 0
+        self.wrong_header = 0
+        self.wrong_protocol = 0
+        self.wrong_serial = 0
+        self.too_short = 0
+        self.unknown_obis = 0 # channels skipped because the decoder does not know them
+        # from the ticker of the meters: frames received twice, arrived after a newer one or never arrived
+        self.duplicates = 0
+        self.reordered = 0
+        self.lost = 0
+        self.select = Histogram() # includes the time spent waiting for data
+        self.recv = Histogram()
+        self.decode = Histogram()
+
+
+def _channel_width(obis):
+    # value width from the type byte of the OBIS id: 4 is an actual value, 8 a counter
+    value_type = obis >> 8 & 0xff
+    if value_type in (4, 8):
+        return value_type
+    if obis >> 24 == CHANNEL_VERSION:
+        return 4
+    return None
+
+
+def _interface_address(sock, interface):
+    # IPv4 address of an interface given by address or by name, as packed bytes
+    try:
+        return socket.inet_aton(interface)
+    except OSError:
+        ifreq = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, struct.pack('256s', interface.encode()[:15]))
+        return ifreq[20:24]
+
+
+def _tuple_getter(indices):
+    # itemgetter returns a bare value for a single index, the frame plan always wants a tuple
+    if len(indices) == 1:
+        index = indices[0]
+        return lambda values: (values[index],)
+    return operator.itemgetter(*indices)
+
+
+class DatagramBuffer:
+    # Preallocated receive buffer. The memoryview of every datagram length is created once and reused, so a
+    # frame is received without copying it. Decoding still allocates the unpacked values of the frame plan,
+    # and recvmsg_into a list for the ancillary data, see tests/bench_decode.py.
+    __slots__ = ('data', 'view', 'views', 'buffers', 'size', 'timestamp')
+
+    def __init__(self, size=DATAGRAM_SIZE):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.views = {}
+        self.buffers = [self.data] # for recvmsg_into
+        self.size = 0
+        self.timestamp = 0.0
+
+    def window(self, size):
+        view = self.views.get(size)
+        if view is None:
+            view = self.views[size] = self.view[:size]
+        return view
+
+    def recv_into(self, sock, flags=0):
+        self.size = sock.recv_into(self.data, len(self.data), flags)
+        self.timestamp = time.time()
+        return self.window(self.size)
+
+    def recvmsg_into(self, sock, flags=0):
+        # receive with the kernel timestamp (SO_TIMESTAMPNS) of the moment the packet arrived
+        self.size, ancdata, _, _ = sock.recvmsg_into(self.buffers, TIMESTAMP_ANCBUFSIZE, flags)
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                seconds, nanoseconds = TIMESPEC.unpack_from(data)
+                self.timestamp = seconds + nanoseconds / 1e9
+                break
+        else:
+            self.timestamp = time.time()
+        return self.window(self.size)
+
+    def load(self, datagram, timestamp=None):
+        if len(datagram) > len(self.data):
+            datagram = datagram[:len(self.data)]
+        self.size = len(datagram)
+        self.data[:self.size] = datagram
+        self.timestamp = time.time() if timestamp is None else timestamp
+        return self.window(self.size)
+
+
+class CaptureWriter:
+    # Appends raw datagrams to a capture file, cheap enough to stay enabled in production
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+        self.file.write(CAPTURE_RECORD.pack(time.monotonic_ns(), 0) + CAPTURE_SESSION.pack(time.time()))
+
+    def write(self, datagram, timestamp_ns=None):
+        if not datagram:
+            return # a record of size 0 marks a new session, see read_capture
+        self.file.write(CAPTURE_RECORD.pack(time.monotonic_ns() if timestamp_ns is None else timestamp_ns, len(datagram)))
+        self.file.write(datagram)
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    # yields (receive time, datagram), the receive time in seconds on the wall clock of the capturing host
+    with open(path, 'rb') as file:
+        if file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f'{path} is not a capture file')
+        session_ns, session_time = 0, 0.0
+        while True:
+            record = file.read(CAPTURE_RECORD.size)
+            if len(record) < CAPTURE_RECORD.size:
+                return
+            timestamp_ns, size = CAPTURE_RECORD.unpack(record)
+            if size == 0:
+                session_ns = timestamp_ns
+                session_time = CAPTURE_SESSION.unpack(file.read(CAPTURE_SESSION.size))[0]
+                continue
+            datagram = file.read(size)
+            if len(datagram) < size: # capture cut off while writing
+                return
+            yield session_time + (timestamp_ns - session_ns) / 1e9, datagram
+
+
+def replay_capture(path, speed=1.0, home_manager=None, on_frame=None, multicast=False):
+    # Feed a capture at its original pace (speed 1), N times faster or, with speed 0, as fast as possible.
+    # The frames are either decoded directly by home_manager, calling on_frame after every frame, or sent to
+    # the multicast group with a TTL of 0 so only processes on this host receive them.
+    if multicast:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 0)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+    start = first = None
+    frames = 0
+    for received, datagram in read_capture(path):
+        if speed:
+            if start is None:
+                start, first = time.monotonic(), received
+            delay = start + (received - first) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        if multicast:
+            sock.sendto(datagram, (MCAST_GRP, MCAST_PORT))
+        else:
+            home_manager.datagram = home_manager.buffer.load(datagram, received)
+            home_manager._decode_data()
+            if on_frame is not None:
+                on_frame()
+        frames += 1
+
+    if multicast:
+        sock.close()
+    return frames
+
+
+class MeterState:
+    # Decoder state of one meter, several meters can share the multicast group
+    __slots__ = ('serial', 'hmdata', 'last_update', 'rx_time', 'ticker', 'ticker_time', 'period', 'lost', 'jitter',
+                 'jitter_max')
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.hmdata = Measurements()
+        self.last_update = time.time()
+        self.rx_time = 0.0
+
+        # Sequence of the frames by the millisecond ticker of the meter, see HomeManager20._sequence
+        self.ticker = None # of the newest frame
+        self.ticker_time = 0.0 # receive time of that frame
+        self.period = None # ms between frames, running average
+        self.lost = 0
+        self.jitter = 0.0 # ms, running average of the receive time deviation from the ticker (RFC 3550)
+        self.jitter_max = 0.0
+
+
+class FramePlan:
+    # Precompiled layout of a frame: one struct unpacks every OBIS id and value at once, the ids are
+    # compared against the expected sequence to verify that a new frame still has the same layout.
+    # get_values and scales are in the order of Measurements.KEYS, see _build_plan.
+    __slots__ = ('offset', 'struct', 'ids', 'get_ids', 'keys', 'present', 'get_values', 'scales', 'fw_index', 'unknown')
+
+    def __init__(self, offset, fmt, ids, id_indices, keys, value_indices, scales, fw_index, unknown):
+        self.offset = offset
+        self.unknown = unknown
+        self.struct = struct.Struct(fmt)
+        self.ids = tuple(ids)
+        self.get_ids = _tuple_getter(id_indices) if ids else lambda values: ()
+        self.keys = tuple(keys)
+        self.present = frozenset(keys)
+        self.get_values = _tuple_getter(value_indices)
+        self.scales = tuple(scales)
+        self.fw_index = fw_index
+
 
 class HomeManager20:
     OBIS_OBJECTS = {
@@ -70,108 +377,617 @@ class HomeManager20:
         0x00470400: {'measurement': 'current_L3', 'format': '>I', 'scale': 1000},
         0x00480400: {'measurement': 'voltage_L3', 'format': '>I', 'scale': 1000},
         0x00490400: {'measurement': 'power_factor_L3', 'format': '>I', 'scale': 1000},
-        0x000402a0: {'measurement': 'current_transformer_ratio', 'format': '>I', 'scale': 1},
-        0x024c0010: {'measurement': 'serial', 'format': '>xxxxIxxxx', 'scale': 1},
         0x90000000: {'measurement': 'fw_version', 'format': '>BBBc', 'scale': 1},
     }
 
-    def __init__(self):
+    # OBIS_OBJECTS compiled once into measurement, prebuilt struct and scale
+    OBIS_DECODERS = {obis: (obj['measurement'], struct.Struct(obj['format']), obj['scale'])
+                     for obis, obj in OBIS_OBJECTS.items()}
+
+    # number of different frame layouts kept before the plan cache is reset
+    MAX_PLANS = 16
+
+    def __init__(self, drain=False, sock=None, connect=True, capture=None, sources=None, interfaces=None, rcvbuf=None,
+                 timestamps=True, relays=None, check_sequence=True, sinks=None):
         self.datagram = None
-        self.hmdata = {}
+        self.hmdata = Measurements()
         self.last_update = time.time()
-            
+        self.channels_start = self.channels_end = 0 # OBIS channels of the current datagram, set by _check_header
+        self.ticker = 0 # ms ticker of the current datagram, set by _check_header
+        # Duplicates and frames older than the newest one of their meter are dropped before decoding, turned
+        # off by benchmarks that decode the same frame over and over
+        self.check_sequence = check_sequence
+        self.rx_time = 0.0 # when the last decoded frame arrived, taken by the kernel with timestamps enabled
+        self.plans = {}
+        self.buffer = DatagramBuffer()
+
+        # Frames are demultiplexed by serial, hmdata and last_update above always follow the last decoded frame
+        self.meters = {}
+        self.updated = [] # serials decoded by the last _decode_data call
+
+        # In drain mode every pending datagram is read in one go and only the newest frame per serial is decoded
+        self.drain = drain
+        self.pending = {}
+        self.frame_buffers = {}
+        self.frames_received = 0
+        self.frames_coalesced = 0
+        self.frames_dropped = 0
+
+        self.stats = DecoderStats()
+        self.log = RateLimitedLog()
+
+        # Raw datagrams are appended to this file when set, see CaptureWriter
+        self.capture = CaptureWriter(capture) if capture else None
+        # Every decoded frame is passed on to the subscribers of these local sockets, see FrameRelay
+        self.relays = relays or []
+        # and to the publish(meter) of these, e.g. homemanager_archive.ArchiveWriter
+        self.sinks = sinks or []
+
+        # Socket tuning: with sources only the meters' traffic passes the kernel (source-specific multicast),
+        # interfaces are names or addresses to join the group on, rcvbuf overrides SO_RCVBUF
+        self.sources = sources or []
+        self.interfaces = interfaces or []
+        self.rcvbuf = rcvbuf
+        self.timestamps = timestamps
+
+        # A socket passed in by the caller (e.g. one end of a socketpair in the benchmarks) is used as is,
+        # without connect there is no socket at all and frames are only fed directly (see replay_capture)
+        self.sock = sock
+        if sock is None and connect:
+            self._connect()
+
+    def _connect(self):
         try:
             # Create the UDP socket
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
             self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-            # # Increase the receive buffer size
-            # sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2**20)
-            
+            if self.rcvbuf:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+            if self.timestamps:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
 
             # Join the multicast group
-            mreq = struct.pack("4sL", socket.inet_aton(MCAST_GRP), socket.INADDR_ANY)
-            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-            print(f"Joined multicast group {MCAST_GRP}")
+            for interface in self.interfaces or [None]:
+                if self.sources:
+                    # ip_mreq_source: group, interface address, source address
+                    address = _interface_address(self.sock, interface) if interface else socket.inet_aton('0.0.0.0')
+                    for source in self.sources:
+                        mreq = socket.inet_aton(MCAST_GRP) + address + socket.inet_aton(source)
+                        self.sock.setsockopt(socket.IPPROTO_IP, IP_ADD_SOURCE_MEMBERSHIP, mreq)
+                        logging.info(f"Joined multicast group {MCAST_GRP} for source {source} on {interface or 'any interface'}")
+                else:
+                    # ip_mreqn: group, interface address, interface index
+                    try:
+                        address, index = socket.inet_aton(interface or '0.0.0.0'), 0
+                    except OSError:
+                        address, index = socket.inet_aton('0.0.0.0'), socket.if_nametoindex(interface)
+                    mreq = struct.pack('4s4si', socket.inet_aton(MCAST_GRP), address, index)
+                    self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+                    logging.info(f"Joined multicast group {MCAST_GRP} on {interface or 'any interface'}")
 
             
 
             # Bind the socket to the multicast port
             self.sock.bind(('', MCAST_PORT))
-            print(f"Socket bound to :{MCAST_PORT}")
+            logging.info(f"Socket bound to :{MCAST_PORT}")
 
         except Exception as e:
-            print(f'Could not connect to multicast group or bind to given interface: {e}')
+            logging.error(f'Could not connect to multicast group or bind to given interface: {e}')
             sys.exit(1)
 
-
+    def close(self):
+        # on shutdown: the tail of a capture and the buffered rows of the sinks are written out
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+        for relay in self.relays:
+            relay.close()
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+        if self.sock is not None:
+            self.sock.close()
 
 
     def _read_data(self, timeout:int):
+        start = time.perf_counter_ns()
         ready = select.select([self.sock], [], [], timeout)
+        self.stats.select.record(time.perf_counter_ns() - start)
 
         if not ready[0]:
             return False
 
-        self.datagram = self.sock.recv(608)
-        if len(self.datagram) < 500: # too short
+        return self._recv_data()
+
+    def _recv_data(self):
+        # non-blocking read, used directly when the socket is watched by the main loop
+        if self.drain:
+            return self._drain_data()
+
+        try:
+            self.datagram = self._recv_into(self.buffer)
+        except BlockingIOError:
             return False
-        
+        if self.capture is not None:
+            self.capture.write(self.datagram)
         return True
 
+    def _drain_data(self):
+        # read every datagram waiting on the socket, newer frames replace older ones of the same serial
+        while True:
+            try:
+                datagram = self._recv_into(self.buffer)
+            except BlockingIOError:
+                break
+            self.frames_received += 1
+            if self.capture is not None:
+                self.capture.write(datagram)
+
+            serial = self._check_header(datagram)
+            if serial is None:
+                self.frames_dropped += 1
+                continue
+            if self.check_sequence and not self._sequence(serial, self.buffer.timestamp):
+                continue
+
+            if serial in self.pending:
+                self.frames_coalesced += 1
+                del self.pending[serial] # keep the dict ordered by arrival of the newest frame
+
+            # the receive buffer is reused for the next datagram, keep a copy in the buffer of this serial
+            frame_buffer = self.frame_buffers.get(serial)
+            if frame_buffer is None:
+                frame_buffer = self.frame_buffers[serial] = DatagramBuffer()
+            frame_buffer.load(datagram, self.buffer.timestamp)
+            self.pending[serial] = frame_buffer
+
+        return bool(self.pending)
+
+    def _recv_into(self, buffer):
+        start = time.perf_counter_ns()
+        if self.timestamps:
+            datagram = buffer.recvmsg_into(self.sock, socket.MSG_DONTWAIT)
+        else:
+            datagram = buffer.recv_into(self.sock, socket.MSG_DONTWAIT)
+        self.stats.recv.record(time.perf_counter_ns() - start)
+        return datagram
+
+    def _reject(self, reason):
+        setattr(self.stats, reason, getattr(self.stats, reason) + 1)
+        self.log.log(logging.DEBUG, reason, 'Frame rejected: %s', reason.replace('_', ' '))
+        return None
+
+    def _check_header(self, datagram):
+        # Validates the frame by its tags and finds the OBIS channels, the usual layout is checked at once
+        if len(datagram) < HEADER.size:
+            return self._reject('too_short')
+
+        sma, group_length, group_tag, _, data_length, data_tag, protocol, _, serial, ticker = HEADER.unpack_from(datagram)
+        if sma != SMA_TAG:
+            return self._reject('wrong_header')
+
+        if group_tag == TAG_GROUP and group_length == 4 and data_tag == TAG_DATA2:
+            data_start = 16
+        else:
+            data_start, data_length = self._find_data2(datagram)
+            if data_start is None:
+                return self._reject('wrong_header')
+            protocol, _, serial, ticker = DATA2_HEADER.unpack_from(datagram, data_start)
+
+        if data_start + data_length > len(datagram):
+            return self._reject('too_short')
+
+        if protocol != 0x6069 : # wrong protocol?
+            return self._reject('wrong_protocol')
+    
+        if serial == 0xffffffff : # wrong serial?
+            return self._reject('wrong_serial')
+
+        self.channels_start = data_start + DATA2_HEADER.size
+        self.channels_end = data_start + data_length
+        self.ticker = ticker
+        return serial
+
+    def _meter(self, serial):
+        meter = self.meters.get(serial)
+        if meter is None:
+            meter = self.meters[serial] = MeterState(serial)
+            logging.info(f'New meter with serial {serial}')
+        return meter
+
+    def _sequence(self, serial, rx_time):
+        # Places the frame just checked in the sequence of its meter by the ticker, False drops it: the same
+        # frame joined on several interfaces arrives twice, and a frame older than the newest one is stale.
+        # Gaps of more than one and a half frame periods count as lost frames. A ticker that jumps back further
+        # than TICKER_SLACK, or stays behind for longer than that, or runs ahead of the receive times by more,
+        # comes from a meter that restarted: the sequence starts over from this frame.
+        meter = self._meter(serial)
+        ticker = self.ticker
+        if meter.ticker is not None:
+            delta = (ticker - meter.ticker) & 0xffffffff # the ticker wraps after 49.7 days
+            elapsed = (rx_time - meter.ticker_time) * 1000
+            if delta == 0:
+                self.stats.duplicates += 1
+                return False
+            if delta & 0x80000000 and 0x100000000 - delta < TICKER_SLACK and elapsed < TICKER_SLACK:
+                self.stats.reordered += 1
+                return False
+            if delta & 0x80000000 or delta > elapsed + TICKER_SLACK:
+                self.log.log(logging.INFO, 'restart', f'Meter {serial} restarted, its ticker jumped by '
+                             f'{delta - 0x100000000 if delta & 0x80000000 else delta} ms')
+                meter.period = None
+            elif meter.period is None:
+                meter.period = delta
+            elif delta < 1.5 * meter.period:
+                meter.period += (delta - meter.period) / 8
+                deviation = abs((rx_time - meter.ticker_time) * 1000 - delta)
+                meter.jitter += (deviation - meter.jitter) / 16
+                if deviation > meter.jitter_max:
+                    meter.jitter_max = deviation
+            else:
+                lost = round(delta / meter.period) - 1
+                meter.lost += lost
+                self.stats.lost += lost
+        meter.ticker = ticker
+        meter.ticker_time = rx_time
+        return True
+
+    def _find_data2(self, datagram):
+        # walk the tags until the data2 tag, returns its data offset and length
+        i = 4
+        while i + TAG.size <= len(datagram):
+            length, tag = TAG.unpack_from(datagram, i)
+            i += TAG.size
+            if tag == TAG_DATA2 and length >= DATA2_HEADER.size:
+                return i, length
+            if tag == TAG_END and length == 0:
+                break
+            i += length
+        return None, 0
+
 
     def _decode_data(self):    
-            
-        if self.datagram[:4] != b'SMA\x00':
-            print('wrong header')
+        self.updated.clear()
+        if self.pending:
+            # drain mode, decode only the newest frame of every serial
+            for frame_buffer in self.pending.values():
+                self.datagram = frame_buffer.window(frame_buffer.size)
+                self.rx_time = frame_buffer.timestamp
+                self._decode_frame(sequenced=True)
+            self.pending.clear()
             return
 
-        if int.from_bytes(self.datagram[16:18], byteorder='big') != 0x6069 : # wrong protocol?
-            print('wrong protocol')
+        self.rx_time = self.buffer.timestamp
+        self._decode_frame()
+
+    def _decode_frame(self, sequenced=False):
+        start = time.perf_counter_ns()
+        serial = self._check_header(self.datagram)
+        if serial is None:
             return
-    
-        serial = int.from_bytes(self.datagram[20:24], byteorder='big')
-        if serial == 0xffffffff : # wrong serial?
-            print('wrong serial')
+        if self.check_sequence and not sequenced and not self._sequence(serial, self.rx_time):
             return
-        
 
+        # Frames with the same layout are decoded with a single unpack of the cached plan
+        plan = self.plans.get(self.channels_end)
+        if plan is not None:
+            values = plan.struct.unpack_from(self.datagram, plan.offset)
+            if plan.offset != self.channels_start or plan.get_ids(values) != plan.ids:
+                plan = None
+        if plan is None:
+            if len(self.plans) >= self.MAX_PLANS:
+                self.plans.clear()
+            plan = self.plans[self.channels_end] = self._build_plan()
+            values = plan.struct.unpack_from(self.datagram, plan.offset)
 
+        meter = self._meter(serial)
+
+        # Fill the record of the meter in place, channels missing from the frame read the 0 appended to the values
         self.last_update = time.time()
-        self.hmdata = {}
-        i = 4
-        while i < len(self.datagram):
-            obis = struct.unpack('>I', self.datagram[i:i + 4])[0]
+        record = self.hmdata = meter.hmdata
+        record.STRUCT.pack_into(record.data, 0, *map(operator.truediv, plan.get_values(values + PAD), plan.scales))
+        record.channels = plan.keys
+        record.present = plan.present
+        record.serial = serial
+        if plan.fw_index is not None:
+            fw = values[plan.fw_index:plan.fw_index + 4]
+            if fw != record.fw:
+                major, minor, build, revision = record.fw = fw
+                record.fw_version = f'{major}.{minor}.{build}.{revision.decode()}'
+
+        meter.last_update = self.last_update
+        meter.rx_time = self.rx_time
+        self.updated.append(serial)
+        for relay in self.relays:
+            relay.publish(meter)
+        for sink in self.sinks:
+            sink.publish(meter)
+
+        self.stats.accepted += 1
+        self.stats.unknown_obis += plan.unknown
+        self.stats.decode.record(time.perf_counter_ns() - start)
+
+    def _build_plan(self):
+        # Walk the OBIS channels once, the type byte gives the width so unknown channels are simply skipped
+        fmt = ['>']
+        ids, id_indices, keys, value_indices, scales = [], [], [], [], []
+        fw_index = None
+        unknown = 0
+        n = 0 # number of items unpacked by the format so far
+        i = self.channels_start
+        while i + 4 <= self.channels_end:
+            obis = OBIS_ID.unpack_from(self.datagram, i)[0]
             i += 4
-            if obis > 0:
-                try:
-                    key = self.OBIS_OBJECTS[obis]['measurement']
-                    size = struct.calcsize(self.OBIS_OBJECTS[obis]['format'])
-                    values = struct.unpack(self.OBIS_OBJECTS[obis]['format'], self.datagram[i:i + size])
-                    if key != 'fw_version':
-                        value = values[0] / self.OBIS_OBJECTS[obis]['scale']
-                    else:
-                        value = f'{values[0]}.{values[1]}.{values[2]}.{values[3].decode()}'
-                    self.hmdata.update({key: value})
-                    print(f'update = {key}: {value}')
-                    i += size
-                except KeyError:
-                    logging.debug(f'Unknown OBIS ID: 0x{obis:08x}')
-                    print(f'Unknown OBIS ID: 0x{obis:08x} - {obis}')
-                    i += 4
-                    return
 
+            decoder = self.OBIS_DECODERS.get(obis)
+            if decoder is None:
+                width = _channel_width(obis)
+                if width is None or i + width > self.channels_end:
+                    self.log.log(logging.DEBUG, 'unknown_width', 'Cannot skip OBIS ID: 0x%08x', obis)
+                    break
+                self.log.log(logging.DEBUG, 'unknown_obis', 'Unknown OBIS ID: 0x%08x', obis)
+                unknown += 1
+                fmt.append(f'{4 + width}x')
+                i += width
+                continue
+            key, value_struct, scale = decoder
+            if i + value_struct.size > self.channels_end:
+                break
+
+            fmt.append('I' + value_struct.format[1:])
+            ids.append(obis)
+            id_indices.append(n)
+            n += 1
+            if key == 'fw_version':
+                fw_index = n
+            else:
+                keys.append(key)
+                value_indices.append(n)
+                scales.append(scale)
+            n += len(value_struct.unpack_from(self.datagram, i))
+            i += value_struct.size
+
+        # the values in the order of the record, n is the index of the PAD appended to the unpacked values
+        found = dict(zip(keys, zip(value_indices, scales)))
+        value_indices, scales = zip(*(found.get(key, (n, 1)) for key in Measurements.KEYS))
+        return FramePlan(self.channels_start, ''.join(fmt), ids, id_indices, keys, value_indices, scales, fw_index, unknown)
+
+
+class Measurements(collections.abc.Mapping):
+    # Fixed-slot record of one meter that the decoder fills in place: data holds a double for every key of KEYS
+    # at its index in INDEX, channels the meter does not send stay 0. Read as a mapping it is the hmdata dict of
+    # before, with the channels of the last frame, serial and fw_version.
+    KEYS = tuple(obj['measurement'] for obj in HomeManager20.OBIS_OBJECTS.values() if obj['measurement'] != 'fw_version')
+    INDEX = {key: i for i, key in enumerate(KEYS)}
+    ZERO = array.array('d', [0.0]) * len(KEYS)
+    STRUCT = struct.Struct(f'{len(KEYS)}d') # packs straight into data, without an intermediate array
+
+    __slots__ = ('data', 'channels', 'present', 'serial', 'fw', 'fw_version')
+
+    def __init__(self):
+        self.data = array.array('d', self.ZERO)
+        self.clear()
+
+    def clear(self):
+        self.data[:] = self.ZERO
+        self.channels = ()
+        self.present = frozenset()
+        self.serial = None
+        self.fw = None
+        self.fw_version = None
+
+    def __getitem__(self, key):
+        if key in self.present:
+            return self.data[self.INDEX[key]]
+        if key == 'serial' and self.serial is not None:
+            return self.serial
+        if key == 'fw_version' and self.fw_version is not None:
+            return self.fw_version
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield from self.channels
+        if self.serial is not None:
+            yield 'serial'
+        if self.fw_version is not None:
+            yield 'fw_version'
+
+    def __len__(self):
+        return len(self.channels) + (self.serial is not None) + (self.fw_version is not None)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class Subscriber:
+    # One client of a FrameRelay: a non-blocking stream socket with a bounded queue of encoded frames
+    __slots__ = ('conn', 'queue', 'offset', 'dropped')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.queue = collections.deque()
+        self.offset = 0 # bytes of queue[0] already sent
+        self.dropped = 0
+
+    def push(self, message, limit):
+        if len(self.queue) >= limit:
+            # drop the oldest frame that has not started to go out, a partly sent one has to be completed
+            del self.queue[1 if self.offset else 0]
+            self.dropped += 1
+        self.queue.append(message)
+
+    def flush(self):
+        # send as much as the socket takes without blocking, raises OSError when the subscriber is gone
+        while self.queue:
+            message = self.queue[0]
+            try:
+                sent = self.conn.send(memoryview(message)[self.offset:])
+            except BlockingIOError:
+                return
+            self.offset += sent
+            if self.offset < len(message):
+                return
+            self.queue.popleft()
+            self.offset = 0
+
+
+class FrameRelay:
+    # Publishes every decoded frame once on a local unix stream socket, so other processes on the GX read the
+    # meters without joining the multicast group or parsing Speedwire. Binary subscribers receive RECORD, a
+    # fixed-size frame: magic, serial, receive time, a bit mask of the channels in the frame and the value of
+    # every Measurements.KEYS entry. JSON subscribers receive one object per line. A subscriber that does not
+    # keep up loses its oldest frames, the decoder never waits for it.
+    RECORD = struct.Struct(f'<4sIdQ{len(Measurements.KEYS)}d')
+
+    def __init__(self, path=RELAY_SOCKET, json_lines=False, queue=RELAY_QUEUE):
+        self.path = path
+        self.json_lines = json_lines
+        self.queue = queue
+        self.subscribers = []
+        self.frames = 0
+        self.dropped = 0 # frames dropped for slow subscribers, including those that have gone
+        self.masks = {} # channels of a frame layout -> bit mask
+        self.log = RateLimitedLog()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(8)
+        self.sock.setblocking(False)
+        logging.info(f"Relaying frames as {'JSON' if json_lines else 'binary records'} on {path}")
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        for subscriber in self.subscribers:
+            subscriber.conn.close()
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _on_connection(self, fd=None, condition=None):
+        # accept every pending subscriber, called from the main loop when the socket is readable
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except BlockingIOError:
+                return True
+            conn.setblocking(False)
+            conn.shutdown(socket.SHUT_RD)
+            self.subscribers.append(Subscriber(conn))
+            logging.info(f'Relay subscriber {len(self.subscribers)} connected to {self.path}')
+
+    def encode(self, meter):
+        record = meter.hmdata
+        if self.json_lines:
+            data, index = record.data, Measurements.INDEX
+            return json.dumps({'serial': meter.serial, 'time': meter.rx_time, 'fw_version': record.fw_version,
+                               'values': {key: data[index[key]] for key in record.channels}}).encode() + b'\n'
+        mask = self.masks.get(record.present)
+        if mask is None:
+            mask = self.masks[record.present] = sum(1 << Measurements.INDEX[key] for key in record.present)
+        return self.RECORD.pack(RELAY_MAGIC, meter.serial, meter.rx_time, mask, *record.data)
+
+    def publish(self, meter):
+        if not self.subscribers:
+            return
+        self.frames += 1
+        message = self.encode(meter)
+        for subscriber in list(self.subscribers):
+            dropped = subscriber.dropped
+            subscriber.push(message, self.queue)
+            try:
+                subscriber.flush()
+            except OSError:
+                self.subscribers.remove(subscriber)
+                subscriber.conn.close()
+                logging.info(f'Relay subscriber disconnected from {self.path}, {subscriber.dropped} frames dropped')
+            if subscriber.dropped != dropped:
+                self.dropped += 1
+                self.log.log(logging.WARNING, 'slow', 'Relay subscriber too slow, dropping frames')
+
+
+def read_relay(path=RELAY_SOCKET):
+    # Generator over the frames of a binary FrameRelay: serial, receive time and a dict of the channels
+    record = FrameRelay.RECORD
+    keys = Measurements.KEYS
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        stream = sock.makefile('rb')
+        while True:
+            data = stream.read(record.size)
+            if len(data) < record.size:
+                return
+            magic, serial, rx_time, mask, *values = record.unpack(data)
+            if magic != RELAY_MAGIC:
+                raise ValueError('not a frame relay stream')
+            yield serial, rx_time, {key: value for i, (key, value) in enumerate(zip(keys, values)) if mask >> i & 1}
+
+
+def add_socket_arguments(parser):
+    parser.add_argument('--source', metavar='IP', action='append', help='only receive frames from this meter, repeat for more meters')
+    parser.add_argument('--interface', metavar='NAME|IP', action='append', help='join the multicast group on this interface')
+    parser.add_argument('--rcvbuf', metavar='BYTES', type=int, help='socket receive buffer size')
+    parser.add_argument('--no-timestamps', action='store_true', help='do not use kernel receive timestamps')
+
+
+def socket_options(args):
+    return {'sources': args.source, 'interfaces': args.interface, 'rcvbuf': args.rcvbuf, 'timestamps': not args.no_timestamps}
+
+
+def add_relay_arguments(parser):
+    parser.add_argument('--relay', metavar='SOCKET', nargs='?', const=RELAY_SOCKET,
+                        help=f'relay every decoded frame as a binary record on a local socket, default {RELAY_SOCKET}')
+    parser.add_argument('--relay-json', metavar='SOCKET', help='relay every decoded frame as a JSON line on a local socket')
+
+
+def relays(args):
+    return ([FrameRelay(args.relay)] if args.relay else []) + ([FrameRelay(args.relay_json, True)] if args.relay_json else [])
 
 
 if __name__ == "__main__":
-    sma = HomeManager20()
+    parser = argparse.ArgumentParser(description='Decode SMA Home Manager 2.0 / Energy Meter multicast frames')
+    parser.add_argument('--drain', action='store_true', help='read the whole socket backlog, keep the newest frame per serial')
+    parser.add_argument('--capture', metavar='FILE', help='append every received datagram to a capture file')
+    parser.add_argument('--replay', metavar='FILE', help='replay a capture file instead of listening to the network')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 replays as fast as possible')
+    parser.add_argument('--multicast', action='store_true', help='replay to the multicast group on this host instead of decoding')
+    parser.add_argument('--subscribe', metavar='SOCKET', nargs='?', const=RELAY_SOCKET,
+                        help=f'print the frames of a running relay instead of listening to the network, default {RELAY_SOCKET}')
+    parser.add_argument('--debug', action='store_true', help='log rejected frames and unknown OBIS ids')
+    add_socket_arguments(parser)
+    add_relay_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    if args.subscribe:
+        for serial, rx_time, values in read_relay(args.subscribe):
+            print(serial, rx_time, values)
+        sys.exit(0)
+
+    if args.replay:
+        sma = None if args.multicast else HomeManager20(connect=False)
+        frames = replay_capture(args.replay, args.speed, sma, on_frame=lambda: print(sma.hmdata), multicast=args.multicast)
+        print(f'replayed {frames} frames')
+        sys.exit(0)
+
+    sma = HomeManager20(drain=args.drain, capture=args.capture, relays=relays(args), **socket_options(args))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    atexit.register(sma.close)
 
     while True:
+        for relay in sma.relays:
+            relay._on_connection()
         if sma._read_data(timeout=1):
             sma._decode_data()
             print(sma.hmdata)
+            if sma.drain:
+                print(f'received: {sma.frames_received} coalesced: {sma.frames_coalesced} dropped: {sma.frames_dropped}')
         else:
             if sma.last_update + 5 < time.time():
                 print('not updated for 5 seconds')
-                sma.hmdata = {}
+                sma.hmdata.clear()
     
\ No newline at end of file
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# Fixed-memory history of the decoded measurements with 1 s, 1 min and 15 min min/max/avg rollups.
+#
+# The frames of the last hours are kept at full rate in a ring of typed arrays, one row of doubles per frame.
+# The rollups are rings of slots that are updated with every frame, so a query over a long window reads a
+# few coarse slots instead of the frames. All memory is allocated up front: 8 bytes per measurement and
+# frame, 24 bytes per measurement and rollup slot, about 6 MB per meter for the defaults.
+#
+# HistoryServer answers queries on a local unix socket, one JSON object per line:
+#   {"op": "summary", "key": "positive_active_demand", "seconds": 900}
+#   {"op": "series", "key": "voltage_L1", "seconds": 3600, "resolution": 60}
+#   {"op": "meters"}, {"op": "keys"}
+# "serial" selects the meter when there is more than one, "start" and "end" (unix time) replace "seconds".
+
+import argparse
+import array
+import contextlib
+import json
+import logging
+import math
+import os
+import socket
+import time
+
+from homemanager_decoder import Measurements
+
+KEYS = Measurements.KEYS
+# resolution and span of the rollups in seconds
+ROLLUPS = ((1, 900), (60, 24 * 3600), (900, 7 * 24 * 3600))
+SOCKET_PATH = '/tmp/dbus-homemanager-history.sock'
+REQUEST_SIZE = 4096 # bytes, a longer request is answered as far as it was read
+QUERY_TIMEOUT = 5 # seconds a client has to send its request and take the answer
+NAN = float('nan')
+
+
+class Rollup:
+    # Ring of slots of `resolution` seconds with min, max and sum of every measurement. Measurements missing
+    # from a dict frame are NaN and make their slot NaN, a meter sends the same channels in every frame.
+    __slots__ = ('resolution', 'capacity', 'width', 'slots', 'count', 'min', 'max', 'sum')
+
+    def __init__(self, width, resolution, span):
+        self.resolution = resolution
+        self.capacity = math.ceil(span / resolution)
+        self.width = width
+        self.slots = array.array('q', [-1]) * self.capacity # slot number (time // resolution) at each position
+        self.count = array.array('I', [0]) * self.capacity
+        self.min = array.array('d', [0.0]) * (self.capacity * width)
+        self.max = array.array('d', [0.0]) * (self.capacity * width)
+        self.sum = array.array('d', [0.0]) * (self.capacity * width)
+
+    def add(self, timestamp, row):
+        slot = int(timestamp // self.resolution)
+        position = slot % self.capacity
+        start = position * self.width
+        end = start + self.width
+        if self.slots[position] != slot:
+            if slot < self.slots[position]:
+                return # older than the ring
+            self.slots[position] = slot
+            self.count[position] = 1
+            self.min[start:end] = row
+            self.max[start:end] = row
+            self.sum[start:end] = row
+            return
+
+        self.count[position] += 1
+        minimum, maximum, total = self.min, self.max, self.sum
+        for i, value in enumerate(row, start):
+            if value < minimum[i]:
+                minimum[i] = value
+            elif value > maximum[i]:
+                maximum[i] = value
+            total[i] += value
+
+    def rows(self, index, first, last):
+        # (slot start time, min, max, avg) of measurement `index` for the slots first..last-1 that hold data
+        first = max(first, last - self.capacity)
+        for slot in range(first, last):
+            position = slot % self.capacity
+            if self.slots[position] != slot:
+                continue
+            i = position * self.width + index
+            yield slot * self.resolution, self.min[i], self.max[i], self.sum[i] / self.count[position]
+
+    def aggregate(self, index, first, last):
+        # min, max, sum and count over the slots first..last-1
+        minimum, maximum, total, count = math.inf, -math.inf, 0.0, 0
+        first = max(first, last - self.capacity)
+        for slot in range(first, last):
+            position = slot % self.capacity
+            if self.slots[position] != slot:
+                continue
+            i = position * self.width + index
+            minimum = min(minimum, self.min[i])
+            maximum = max(maximum, self.max[i])
+            total += self.sum[i]
+            count += self.count[position]
+        return minimum, maximum, total, count
+
+
+class History:
+    def __init__(self, hours=1, frame_rate=1, keys=KEYS, rollups=ROLLUPS):
+        self.keys = tuple(keys)
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self.width = len(self.keys)
+        self.capacity = max(1, int(hours * 3600 * frame_rate))
+        self.times = array.array('d', [NAN]) * self.capacity
+        self.values = array.array('d', [NAN]) * (self.capacity * self.width)
+        self.position = 0
+        self.frames = 0
+        self.rollups = [Rollup(self.width, resolution, span) for resolution, span in rollups]
+
+    def append(self, timestamp, hmdata):
+        # the record of the decoder already is a row, channels the meter does not send are 0 there
+        if isinstance(hmdata, Measurements) and self.keys == KEYS:
+            row = hmdata.data
+        else:
+            row = array.array('d', [hmdata.get(key, NAN) for key in self.keys])
+        start = self.position * self.width
+        self.values[start:start + self.width] = row
+        self.times[self.position] = timestamp
+        self.position = (self.position + 1) % self.capacity
+        self.frames += 1
+        for rollup in self.rollups:
+            rollup.add(timestamp, row)
+
+    def latest(self, key):
+        position = (self.position - 1) % self.capacity
+        return self.times[position], self.values[position * self.width + self.index[key]]
+
+    def frames_between(self, key, start, end):
+        # (time, value) of the raw frames in [start, end), oldest first
+        index = self.index[key]
+        count = min(self.frames, self.capacity)
+        for n in range(count):
+            position = (self.position - count + n) % self.capacity
+            timestamp = self.times[position]
+            if start <= timestamp < end:
+                yield timestamp, self.values[position * self.width + index]
+
+    def series(self, key, start, end, resolution):
+        if not resolution:
+            return [[timestamp, _number(value)] for timestamp, value in self.frames_between(key, start, end)]
+        for rollup in self.rollups:
+            if rollup.resolution == resolution:
+                break
+        else:
+            raise ValueError(f'no rollup with a resolution of {resolution} s')
+        first, last = int(start // resolution), math.ceil(end / resolution)
+        return [[timestamp, *map(_number, values)] for timestamp, *values in rollup.rows(self.index[key], first, last)]
+
+    def summary(self, key, start, end):
+        # The whole slots of the coarsest rollup inside the window, the remainder at both ends from the finer
+        # ones and the partial seconds at the ends from the raw frames, all of a partial minute when it is
+        # older than the span of the finest rollup. Ends older than the raw ring come from the finest rollup,
+        # rounded out to whole seconds, or in to whole minutes when older than its span.
+        minimum, maximum, total, count = self._aggregate(self.index[key], start, end, len(self.rollups) - 1)
+        if not count or math.isnan(total):
+            return None
+        return {'min': minimum, 'max': maximum, 'avg': total / count, 'frames': count}
+
+    def _aggregate(self, index, start, end, level):
+        rollup = self.rollups[level]
+        resolution = rollup.resolution
+        first, last = math.ceil(start / resolution), int(end // resolution)
+        if level == 0:
+            newest = self.times[(self.position - 1) % self.capacity]
+            if first >= last or first <= newest // resolution - rollup.capacity:
+                return self._edge(index, start, end)
+            return _combine(rollup.aggregate(index, first, last), self._edge(index, start, first * resolution),
+                            self._edge(index, last * resolution, end))
+
+        if first >= last:
+            return self._aggregate(index, start, end, level - 1)
+        return _combine(rollup.aggregate(index, first, last), self._aggregate(index, start, first * resolution, level - 1),
+                        self._aggregate(index, last * resolution, end, level - 1))
+
+    def _edge(self, index, start, end):
+        # the raw frames, or the finest rollup rounded out to whole seconds when the ring no longer holds them
+        raw = self._raw(index, start, end)
+        if raw is not None:
+            return raw
+        resolution = self.rollups[0].resolution
+        return self.rollups[0].aggregate(index, int(start // resolution), math.ceil(end / resolution))
+
+
+    def _raw(self, index, start, end):
+        # min, max, sum and count of the raw frames in [start, end), None when the ring no longer reaches back
+        # to start
+        count = min(self.frames, self.capacity)
+        oldest = (self.position - count) % self.capacity
+        if self.frames > self.capacity and self.times[oldest] > start:
+            return None
+        minimum, maximum, total = math.inf, -math.inf, 0.0
+        first, last = self._find(start, count), self._find(end, count)
+        for n in range(first, last):
+            value = self.values[(oldest + n) % self.capacity * self.width + index]
+            minimum = min(minimum, value)
+            maximum = max(maximum, value)
+            total += value
+        return minimum, maximum, total, last - first
+
+    def _find(self, timestamp, count):
+        # the first of the last count frames, oldest first, at or after timestamp
+        oldest, low, high = self.position - count, 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[(oldest + middle) % self.capacity] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+def _combine(*parts):
+    return (min(part[0] for part in parts), max(part[1] for part in parts), sum(part[2] for part in parts),
+            sum(part[3] for part in parts))
+
+
+def _number(value):
+    # NaN is not JSON, the meter did not send this measurement
+    return None if math.isnan(value) else value
+
+
+class Query:
+    # One client of the HistoryServer: the request as far as it was read, then the answer still to be sent
+    __slots__ = ('conn', 'request', 'answer', 'source')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.request = b''
+        self.answer = None
+        self.source = None # the IO watch of the connection
+
+
+class HistoryServer:
+    # Local query API on a unix stream socket, one request and one answer per connection. Every socket is
+    # non-blocking and served by IO watches on the GLib main loop of the bridge, see fileno() and
+    # _on_connection(): a slow or stalled client never holds up publishing, it is dropped after QUERY_TIMEOUT.
+    def __init__(self, histories, path=SOCKET_PATH, glib=None):
+        if glib is None:
+            from gi.repository import GLib as glib
+        self.glib = glib
+        self.histories = histories # serial -> History, filled by the bridge
+        self.queries = set()
+        self.path = path
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(4)
+        self.sock.setblocking(False)
+        logging.info(f'History queries on {path}')
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        for query in list(self.queries):
+            self._close(query)
+        self.sock.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+    def _on_connection(self, fd=None, condition=None):
+        # accept every pending client, called from the main loop when the socket is readable
+        glib = self.glib
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except BlockingIOError:
+                return True
+            conn.setblocking(False)
+            query = Query(conn)
+            self.queries.add(query)
+            query.source = glib.io_add_watch(conn.fileno(), glib.PRIORITY_DEFAULT, glib.IO_IN | glib.IO_HUP | glib.IO_ERR,
+                                             self._on_request, query)
+            glib.timeout_add_seconds(QUERY_TIMEOUT, self._expire, query)
+
+    def _on_request(self, fd, condition, query):
+        # reads what the client sent so far, answers once the request is complete
+        while not query.request.endswith(b'\n') and len(query.request) < REQUEST_SIZE:
+            try:
+                data = query.conn.recv(REQUEST_SIZE)
+            except BlockingIOError:
+                return True
+            except OSError:
+                self._close(query)
+                return False
+            if not data:
+                break
+            query.request += data
+        try:
+            answer = self.answer(json.loads(query.request))
+        except (ValueError, KeyError, TypeError) as e:
+            answer = {'error': str(e)}
+        query.answer = memoryview(json.dumps(answer).encode() + b'\n')
+
+        glib = self.glib
+        glib.source_remove(query.source)
+        query.source = glib.io_add_watch(fd, glib.PRIORITY_DEFAULT, glib.IO_OUT | glib.IO_HUP | glib.IO_ERR,
+                                         self._on_answer, query)
+        return False
+
+    def _on_answer(self, fd, condition, query):
+        # sends as much of the answer as the socket takes
+        try:
+            query.answer = query.answer[query.conn.send(query.answer):]
+        except BlockingIOError:
+            return True
+        except OSError:
+            query.answer = None # the client is gone
+        if query.answer:
+            return True
+        self._close(query)
+        return False
+
+    def _expire(self, query):
+        if query in self.queries:
+            logging.debug('History query timed out')
+            self._close(query)
+        return False
+
+    def _close(self, query):
+        self.queries.discard(query)
+        if query.source is not None:
+            self.glib.source_remove(query.source)
+            query.source = None
+        query.conn.close()
+
+    def answer(self, request):
+        # the types are checked up front, a request of the wrong shape is answered with an error too
+        if not isinstance(request, dict):
+            raise TypeError('the request is not an object')
+        op = _field(request, 'op', str, 'summary')
+        if op == 'meters':
+            return {'meters': list(self.histories)}
+
+        serial = _field(request, 'serial', int, None)
+        if serial is None and len(self.histories) == 1:
+            serial = next(iter(self.histories))
+        history = self.histories[serial]
+        if op == 'keys':
+            return {'keys': history.keys}
+
+        key = _field(request, 'key', str)
+        if key not in history.index:
+            raise KeyError(f'unknown measurement {key}')
+        end = _field(request, 'end', (int, float), time.time())
+        start = _field(request, 'start', (int, float), end - _field(request, 'seconds', (int, float), 900))
+        if op == 'summary':
+            return {'serial': serial, 'key': key, 'start': start, 'end': end, 'summary': history.summary(key, start, end)}
+        if op == 'series':
+            resolution = _field(request, 'resolution', (int, float), 60)
+            return {'serial': serial, 'key': key, 'resolution': resolution,
+                    'series': history.series(key, start, end, resolution)}
+        raise ValueError(f'unknown op {op}')
+
+
+def _field(request, name, types, default=KeyError):
+    # request[name] of one of types, default when it is missing; True and False are no numbers here
+    value = request.get(name, default)
+    if value is KeyError:
+        raise KeyError(f'missing {name}')
+    if value is not default and (isinstance(value, bool) or not isinstance(value, types)):
+        raise TypeError(f'{name} must be {types.__name__ if isinstance(types, type) else "a number"}')
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError(f'{name} must be finite') # JSON of Python allows NaN and Infinity
+    return value
+
+
+def query(request, path=SOCKET_PATH, timeout=5):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        answer = b''
+        while not answer.endswith(b'\n'):
+            data = sock.recv(65536)
+            if not data:
+                break
+            answer += data
+    return json.loads(answer)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query the measurement history of a running dbus-homemanager.py')
+    parser.add_argument('op', choices=('summary', 'series', 'meters', 'keys'))
+    parser.add_argument('key', nargs='?', default='positive_active_demand')
+    parser.add_argument('--seconds', type=float, default=900, help='window ending now, default 900')
+    parser.add_argument('--resolution', type=int, default=60, help='series resolution in seconds, 0 for every frame')
+    parser.add_argument('--serial', type=int, help='meter, needed when there is more than one')
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    args = parser.parse_args()
+
+    request = {'op': args.op, 'key': args.key, 'seconds': args.seconds, 'resolution': args.resolution}
+    if args.serial is not None:
+        request['serial'] = args.serial
+    print(json.dumps(query(request, args.socket), indent=1))
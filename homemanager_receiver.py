@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+# Receiver process: the multicast socket and HomeManager20 in a process of their own, decoded frames handed to
+# the bridge through shared memory.
+#
+# The child process receives, sequences and decodes every frame like the bridge does in-process, relays,
+# capture and archive included, and writes the newest frame of every meter into its fixed slot of a shared
+# memory block. One message on a socketpair wakes the bridge per batch. Receiving never waits for dbus, and
+# on a GX with two cores decoding and publishing run in parallel. The child is this file run by a fresh
+# interpreter, it shares no dbus connection or GLib state with the bridge. When it exits the bridge reads the
+# end of the socketpair and starts it again right away.
+#
+# Every slot is guarded by a seqlock: the writer makes the sequence number odd, writes the frame, stores a
+# CRC32 of it and makes the sequence number even again. The reader copies the frame into the record of its
+# meter and keeps it only when the sequence number is even and unchanged and the CRC matches, otherwise it
+# reads again. Neither side ever takes a lock or waits for the other. The CRC catches a torn read even where
+# the CPU reorders the stores of the writer, Python has no memory barriers. The decoder statistics are
+# written the same way ten times a second.
+#
+# ReceiverProcess stands in for HomeManager20 in DbusSmaBridge and DbusSmaService: sock, _recv_data,
+# _read_data, _decode_data, meters, updated and stats behave the same.
+
+import argparse
+import atexit
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+
+from homemanager_decoder import DecoderStats, FrameRelay, Histogram, HomeManager20, Measurements, MeterState
+
+RECEIVER_SLOTS = 8 # meters the shared memory has room for
+RECEIVER_MAGIC = b'HMS1'
+RECEIVER_RETRIES = 100 # reads of a slot the writer is busy with before it is left for the next wakeup
+STATS_PERIOD = 0.1 # seconds between two updates of the statistics block
+FLUSH_PERIOD = 60 # seconds between two flushes of the sinks, e.g. the archive
+RESTART_DELAY = 5 # seconds, a receiver that exits sooner after its start is restarted after this delay
+
+BLOCK_HEADER = struct.Struct('<4sII') # magic, slots, pid of the receiver
+SEQ = struct.Struct('<Q')
+# sequence number, serial, CRC32 of the payload
+SLOT_HEADER = struct.Struct('<QII')
+# receive time, frame period (0 while unknown), jitter, max jitter, bit mask of the channels in the frame,
+# lost frames, firmware version
+PAYLOAD_HEADER = struct.Struct('<ddddQQ4s4x')
+PAYLOAD_SIZE = PAYLOAD_HEADER.size + Measurements.STRUCT.size
+SLOT_SIZE = SLOT_HEADER.size + PAYLOAD_SIZE
+
+HISTOGRAMS = ('select', 'recv', 'decode')
+COUNTERS = tuple(name for name in DecoderStats.__slots__ if name not in HISTOGRAMS)
+FRAME_COUNTERS = ('frames_received', 'frames_coalesced', 'frames_dropped')
+HISTOGRAM_SIZE = len(Histogram().buckets) + 3 # buckets, count, total, max
+
+
+class RelayStats:
+    # what the statistics of DbusSmaService read from a FrameRelay that runs in the receiver process
+    __slots__ = ('subscribers', 'dropped')
+
+    def __init__(self):
+        self.subscribers = ()
+        self.dropped = 0
+
+
+class SnapshotBlock:
+    # Layout of the shared memory: the block header, the statistics under their own sequence number, then the
+    # slots of the meters. A slot belongs to the serial written into it first.
+    def __init__(self, buf, slots=RECEIVER_SLOTS, relays=0):
+        self.buf = buf
+        self.slots = slots
+        self.stats = struct.Struct(f'<Q{len(COUNTERS) + len(FRAME_COUNTERS) + 2 * relays + 3 * HISTOGRAM_SIZE}Q')
+        self.stats_offset = BLOCK_HEADER.size
+        self.slots_offset = self.stats_offset + self.stats.size
+        self.size = self.slots_offset + slots * SLOT_SIZE
+
+    def slot_offset(self, slot):
+        return self.slots_offset + slot * SLOT_SIZE
+
+
+def _block_size(slots, relays):
+    return SnapshotBlock(None, slots, relays).size
+
+
+class SnapshotWriter:
+    # Sink of HomeManager20 in the receiver process, writes every decoded frame into the slot of its meter
+    def __init__(self, block):
+        self.block = block
+        self.slots = {} # serial -> slot
+        self.seqs = [0] * block.slots
+        self.masks = {} # channels of a frame layout -> bit mask
+        self.stats_seq = 0
+        self.full = False
+
+    def publish(self, meter):
+        slot = self.slots.get(meter.serial)
+        if slot is None:
+            if len(self.slots) >= self.block.slots:
+                if not self.full:
+                    self.full = True
+                    logging.error(f'No slot left for meter {meter.serial}, only {self.block.slots} meters are passed on')
+                return
+            slot = self.slots[meter.serial] = len(self.slots)
+        buf, offset = self.block.buf, self.block.slot_offset(slot)
+        record = meter.hmdata
+        mask = self.masks.get(record.present)
+        if mask is None:
+            mask = self.masks[record.present] = sum(1 << Measurements.INDEX[key] for key in record.present)
+        fw = bytes(record.fw[:3]) + record.fw[3] if record.fw else bytes(4)
+
+        seq = self.seqs[slot] + 1
+        SEQ.pack_into(buf, offset, seq) # odd: being written
+        payload = offset + SLOT_HEADER.size
+        PAYLOAD_HEADER.pack_into(buf, payload, meter.rx_time, meter.period or 0.0, meter.jitter, meter.jitter_max, mask,
+                                 meter.lost, fw)
+        values = payload + PAYLOAD_HEADER.size
+        buf[values:values + Measurements.STRUCT.size] = memoryview(record.data).cast('B')
+        crc = zlib.crc32(buf[payload:payload + PAYLOAD_SIZE])
+        SLOT_HEADER.pack_into(buf, offset, seq, meter.serial, crc)
+        self.seqs[slot] = seq + 1
+        SEQ.pack_into(buf, offset, seq + 1) # even: complete
+
+    def write_stats(self, home_manager):
+        stats = home_manager.stats
+        values = [getattr(stats, name) for name in COUNTERS]
+        values += [getattr(home_manager, name) for name in FRAME_COUNTERS]
+        for relay in home_manager.relays:
+            values += [len(relay.subscribers), relay.dropped]
+        for name in HISTOGRAMS:
+            histogram = getattr(stats, name)
+            values += histogram.buckets + [histogram.count, histogram.total, histogram.max]
+        buf, offset = self.block.buf, self.block.stats_offset
+        self.block.stats.pack_into(buf, offset, self.stats_seq + 1, *values)
+        self.stats_seq += 2
+        SEQ.pack_into(buf, offset, self.stats_seq)
+
+
+def _receive(block, wakeup, parent, options):
+    # Main loop of the receiver process, ends with the bridge: when its pid is gone or the wakeup socket breaks
+    running = [True]
+    signal.signal(signal.SIGTERM, lambda signum, frame: running.clear())
+    writer = SnapshotWriter(block)
+    home_manager = HomeManager20(**options)
+    sinks = list(home_manager.sinks)
+    home_manager.sinks.append(writer)
+    BLOCK_HEADER.pack_into(block.buf, 0, RECEIVER_MAGIC, block.slots, os.getpid())
+    stats_time = flush_time = time.monotonic()
+    while running and os.getppid() == parent:
+        for relay in home_manager.relays:
+            relay._on_connection()
+        if home_manager._read_data(timeout=1):
+            home_manager._decode_data()
+            if home_manager.updated:
+                try:
+                    wakeup.send(b'\0')
+                except BlockingIOError:
+                    pass # the bridge is behind and has wakeups pending, it reads every slot on each of them
+                except OSError:
+                    break
+        now = time.monotonic()
+        if now >= stats_time:
+            stats_time = now + STATS_PERIOD
+            writer.write_stats(home_manager)
+        if now >= flush_time:
+            flush_time = now + FLUSH_PERIOD
+            for sink in sinks:
+                if hasattr(sink, 'flush'):
+                    sink.flush()
+    home_manager.sinks.remove(writer)
+    home_manager.close()
+
+
+class ReceiverProcess:
+    # The bridge side: starts the receiver process and reads its snapshots. options are the socket options of
+    # HomeManager20 and drain. relays (FrameRelay) are closed here and opened again by the receiver process on
+    # their paths, capture and archive are the paths the receiver process writes to. glib is the main loop
+    # that runs a delayed restart.
+    def __init__(self, slots=RECEIVER_SLOTS, relays=None, capture=None, archive=None, glib=None, **options):
+        if glib is None:
+            from gi.repository import GLib as glib
+        self.glib = glib
+        relays = relays or []
+        self.options = {**options, 'capture': capture, 'archive': archive,
+                        'relays': [(relay.path, relay.json_lines, relay.queue) for relay in relays]}
+        for relay in relays:
+            relay.close()
+        relays = len(relays)
+        self.block_size = _block_size(slots, relays)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.block_size)
+        self.block = SnapshotBlock(self.shm.buf, slots, relays)
+        self.block.buf[:] = bytes(self.block_size)
+
+        atexit.register(self.close)
+
+        # the names HomeManager20 offers to DbusSmaBridge and DbusSmaService
+        self.hmdata = Measurements()
+        self.last_update = time.time()
+        self.rx_time = 0.0
+        self.meters = {}
+        self.updated = []
+        self._stats = DecoderStats()
+        self.relays = [RelayStats() for _ in range(relays)]
+        self.frames_received = 0
+        self.frames_coalesced = 0
+        self.frames_dropped = 0
+
+        self.seqs = [0] * slots # sequence number of the last snapshot read per slot
+        self.views = {} # serial -> bytes of the values of its record
+        self.fws = {} # serial -> firmware version as written by the receiver
+        self.scratch = bytearray(PAYLOAD_SIZE)
+        self.scratch_values = memoryview(self.scratch)[PAYLOAD_HEADER.size:]
+        self.masks = {} # bit mask -> channels, present
+        self.pending = []
+        self.stats_seq = 0
+        self.torn = 0 # reads that caught the writer in the middle of a frame
+        self.restarts = 0
+
+        self.process = None
+        self.started = 0.0
+        self.restart_source = None # the timer of a delayed restart
+        self.sock = None
+        self.wakeup = None # the end of the receiver, held here while no receiver runs
+        self._socketpair()
+        self._start()
+
+    def _socketpair(self):
+        # The main loop watches the fd of sock: a new pair takes over the same fd. It reads the end of the
+        # pair when the receiver exits, the socket of every process closes with it.
+        sock, wakeup = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.setblocking(False)
+        if self.sock is None:
+            self.sock = sock
+        else:
+            os.dup2(sock.fileno(), self.sock.fileno())
+            sock.close()
+        if self.wakeup is not None:
+            self.wakeup.close()
+        self.wakeup = wakeup
+
+    def _start(self):
+        wakeup = self.wakeup.fileno()
+        command = [sys.executable, os.path.abspath(__file__), '--shm', self.shm.name, '--slots', str(self.block.slots),
+                   '--wakeup', str(wakeup), '--parent', str(os.getpid()), '--options', json.dumps(self.options)]
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            command.append('--debug')
+        self.process = subprocess.Popen(command, pass_fds=(wakeup,))
+        self.started = time.monotonic()
+        self.wakeup.close()
+        self.wakeup = None
+        logging.info(f'Receiver process {self.process.pid} started, {self.block.slots} meter slots in {self.shm.name}')
+
+    def close(self):
+        if self.shm is None:
+            return
+        if self.restart_source is not None:
+            self.glib.source_remove(self.restart_source)
+            self.restart_source = None
+        if self.process is not None:
+            self.process.terminate() # the receiver closes its capture and sinks, it waits for 1 s at most
+            try:
+                self.process.wait(2)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+        self.sock.close()
+        if self.wakeup is not None:
+            self.wakeup.close()
+        self.block.buf = None
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+    def _on_exit(self):
+        # A receiver process that exited is started again right away. One that exits right after its start,
+        # e.g. because the multicast group cannot be joined, after RESTART_DELAY seconds.
+        logging.error(f'Receiver process exited with {self.process.returncode}')
+        self.process = None
+        self._socketpair() # the old pair reads as closed for good
+        if time.monotonic() < self.started + RESTART_DELAY:
+            self.restart_source = self.glib.timeout_add(RESTART_DELAY * 1000, self._restart)
+        else:
+            self._restart()
+
+    def _restart(self):
+        # the new receiver starts with empty slots, it numbers them from scratch
+        self.restart_source = None
+        self.restarts += 1
+        self.seqs = [0] * self.block.slots
+        self.block.buf[:] = bytes(self.block_size)
+        self._start()
+        return False
+
+    def _read_data(self, timeout:int):
+        ready = select.select([self.sock], [], [], timeout)
+        if not ready[0]:
+            return False
+        return self._recv_data()
+
+    def _recv_data(self):
+        # take the wakeups of the receiver, then every slot with a frame not read yet
+        try:
+            while self.sock.recv(64):
+                pass
+            # the end of the socketpair: the receiver is exiting, or hangs in its exit and is stopped
+            try:
+                self.process.wait(1)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self._on_exit()
+        except BlockingIOError:
+            pass
+        for slot in range(self.block.slots):
+            serial = self._read_slot(slot)
+            if serial is not None:
+                self.pending.append(serial)
+        return bool(self.pending)
+
+    def _read_slot(self, slot):
+        buf, offset = self.block.buf, self.block.slot_offset(slot)
+        payload = offset + SLOT_HEADER.size
+        for _ in range(RECEIVER_RETRIES):
+            seq, serial, crc = SLOT_HEADER.unpack_from(buf, offset)
+            if seq == self.seqs[slot]:
+                return None
+            if not seq & 1:
+                self.scratch[:] = buf[payload:payload + PAYLOAD_SIZE]
+                if SEQ.unpack_from(buf, offset)[0] == seq and zlib.crc32(self.scratch) == crc:
+                    break
+            self.torn += 1
+        else:
+            return None
+        self.seqs[slot] = seq
+
+        meter = self.meters.get(serial)
+        if meter is None:
+            meter = self.meters[serial] = MeterState(serial)
+            meter.hmdata.serial = serial
+            self.views[serial] = memoryview(meter.hmdata.data).cast('B')
+        record = meter.hmdata
+        meter.rx_time, period, meter.jitter, meter.jitter_max, mask, meter.lost, fw = PAYLOAD_HEADER.unpack_from(self.scratch)
+        meter.period = period or None
+        self.views[serial][:] = self.scratch_values
+        layout = self.masks.get(mask)
+        if layout is None:
+            channels = tuple(key for i, key in enumerate(Measurements.KEYS) if mask >> i & 1)
+            layout = self.masks[mask] = (channels, frozenset(channels))
+        record.channels, record.present = layout
+        if fw != self.fws.get(serial) and any(fw):
+            self.fws[serial] = fw
+            major, minor, build, revision = record.fw = (fw[0], fw[1], fw[2], fw[3:])
+            record.fw_version = f'{major}.{minor}.{build}.{revision.decode()}'
+        meter.last_update = time.time()
+        return serial
+
+    def _decode_data(self):
+        # the frames were decoded by the receiver process, the records of this batch are already filled
+        self.updated.clear()
+        for serial in self.pending:
+            if serial not in self.updated:
+                self.updated.append(serial)
+            meter = self.meters[serial]
+            self.hmdata = meter.hmdata
+            self.rx_time = meter.rx_time
+            self.last_update = meter.last_update
+        self.pending.clear()
+
+    @property
+    def stats(self):
+        # read by the statistics timer of every service
+        self._read_stats()
+        return self._stats
+
+    def _read_stats(self):
+        layout, buf, offset = self.block.stats, self.block.buf, self.block.stats_offset
+        seq = SEQ.unpack_from(buf, offset)[0]
+        if seq & 1 or seq == self.stats_seq:
+            return
+        values = layout.unpack_from(buf, offset)
+        if values[0] != seq or SEQ.unpack_from(buf, offset)[0] != seq:
+            return # being written, next time
+        self.stats_seq = seq
+        values = iter(values[1:])
+        for name in COUNTERS:
+            setattr(self._stats, name, next(values))
+        for name in FRAME_COUNTERS:
+            setattr(self, name, next(values))
+        for relay in self.relays:
+            relay.subscribers = range(next(values))
+            relay.dropped = next(values)
+        for name in HISTOGRAMS:
+            histogram = getattr(self._stats, name)
+            histogram.buckets = [next(values) for _ in histogram.buckets]
+            histogram.count, histogram.total, histogram.max = next(values), next(values), next(values)
+
+
+def _attach(name):
+    # The bridge owns the block and unlinks it, the resource tracker of this process must not (Python < 3.13
+    # has no track argument)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+if __name__ == "__main__":
+    # Started by ReceiverProcess, not by hand
+    parser = argparse.ArgumentParser(description='Receiver process of dbus-homemanager.py --receiver-process')
+    parser.add_argument('--shm', required=True, help='name of the shared memory block')
+    parser.add_argument('--slots', type=int, required=True, help='meter slots in the block')
+    parser.add_argument('--wakeup', type=int, required=True, help='fd of the socket that wakes the bridge')
+    parser.add_argument('--parent', type=int, required=True, help='pid of the bridge, the receiver ends with it')
+    parser.add_argument('--options', type=json.loads, required=True, help='HomeManager20 options as JSON')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s receiver %(levelname)s %(message)s')
+
+    options = args.options
+    relays = [FrameRelay(path, json_lines, queue) for path, json_lines, queue in options.pop('relays')]
+    archive = options.pop('archive')
+    if archive:
+        from homemanager_archive import ArchiveWriter
+        options['sinks'] = [ArchiveWriter(archive)]
+    shm = _attach(args.shm)
+    wakeup = socket.socket(fileno=args.wakeup)
+    wakeup.setblocking(False)
+    _receive(SnapshotBlock(shm.buf, args.slots, len(relays)), wakeup, args.parent, dict(options, relays=relays))
+    shm.close()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Batch decode of a capture with homemanager_archive.decode_capture against replaying it through
+# HomeManager20._decode_data frame by frame, on a synthetic capture of every frame layout. Needs numpy.
+#
+#   python3 tests/bench_archive.py [frames per meter]
+
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+from homemanager_archive import KEYS, ArchiveWriter, ArchiveReader, decode_capture
+from homemanager_decoder import CaptureWriter, HomeManager20, replay_capture
+from speedwire_frames import SCENARIOS, FrameGenerator
+
+
+def write_capture(path, count):
+    generators = [FrameGenerator(serial=1900000000 + i, **SCENARIOS[scenario]) for i, scenario in enumerate(SCENARIOS)]
+    capture = CaptureWriter(path)
+    start = time.monotonic_ns()
+    for n in range(count):
+        for generator in generators:
+            capture.write(generator.next(), start + n * generator.period_ms * 1000000)
+    capture.close()
+    return count * len(generators)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    print(f'{platform.machine()} {platform.processor() or platform.platform()} python {platform.python_version()}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.cap')
+        frames = write_capture(path, count)
+
+        start = time.perf_counter()
+        replay_capture(path, 0, HomeManager20(connect=False))
+        before = time.perf_counter() - start
+        start = time.perf_counter()
+        meters = decode_capture(path)
+        after = time.perf_counter() - start
+        print(f'_decode_data per frame {before / frames * 1e6:8.1f} us/frame {frames / before:10.0f} frames/s')
+        print(f'decode_capture         {after / frames * 1e6:8.1f} us/frame {frames / after:10.0f} frames/s')
+        print(f'speedup {before / after:.1f}x')
+
+        # the batch decoder must write what the archive sink writes when the frames are decoded one by one
+        archive = os.path.join(directory, 'archive')
+        writer = ArchiveWriter(archive)
+        replay_capture(path, 0, HomeManager20(connect=False, sinks=[writer]))
+        writer.flush()
+        reader = ArchiveReader(archive)
+        for serial, columns in meters.items():
+            archived = reader.read(serial, columns['time'][0], columns['time'][-1] + 1)
+            for name in ('time', 'mask', *KEYS):
+                assert numpy.array_equal(archived[name], columns[name]), f'{serial} {name} differs'
+        print(f'{len(meters)} meters, {sum(len(columns["time"]) for columns in meters.values())} frames identical')
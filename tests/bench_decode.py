@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# Before/after benchmark of HomeManager20._decode_data.
+#
+# Run it on the GX itself to get numbers for the Venus GX / Cerbo GX ARM cores:
+#   python3 tests/bench_decode.py [frames]
+
+import gc
+import operator
+import os
+import platform
+import socket
+import struct
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+from fake_vedbus import load_dbus_homemanager
+from homemanager_decoder import PAD, HomeManager20, Measurements
+from speedwire_frames import FrameGenerator
+
+ALLOCATION_SLACK = 256 # bytes allocated per frame next to the unpacked values
+
+dbus_homemanager = load_dbus_homemanager()
+
+
+# the old decoder read the tags in front of the OBIS channels as if they were OBIS ids
+LEGACY_OBIS_OBJECTS = dict(HomeManager20.OBIS_OBJECTS)
+LEGACY_OBIS_OBJECTS[0x000402a0] = {'measurement': 'current_transformer_ratio', 'format': '>I', 'scale': 1}
+LEGACY_OBIS_OBJECTS[0x024c0010] = {'measurement': 'serial', 'format': '>xxxxIxxxx', 'scale': 1}
+
+
+def legacy_decode(datagram, out):
+    # _decode_data as it was before the precompiled frame plans, for comparison
+    hmdata = {}
+    objects = LEGACY_OBIS_OBJECTS
+    i = 4
+    while i < len(datagram):
+        obis = struct.unpack('>I', datagram[i:i + 4])[0]
+        i += 4
+        if obis > 0:
+            try:
+                key = objects[obis]['measurement']
+                size = struct.calcsize(objects[obis]['format'])
+                values = struct.unpack(objects[obis]['format'], datagram[i:i + size])
+                if key != 'fw_version':
+                    value = values[0] / objects[obis]['scale']
+                else:
+                    value = f'{values[0]}.{values[1]}.{values[2]}.{values[3].decode()}'
+                hmdata.update({key: value})
+                print(f'update = {key}: {value}', file=out)
+                i += size
+            except KeyError:
+                return hmdata
+    return hmdata
+
+
+def legacy_read(hmdata):
+    # DbusSmaService._publish as it was when hmdata was a dict per frame
+    values = {}
+    if hmdata.get('current_L2', False) is False and hmdata.get('current_L3', False) is False:
+        values['/Ac/Current'] = hmdata.get('current_L1', 0)
+    else:
+        values['/Ac/Current'] = round((hmdata.get('current_L1', 0) + hmdata.get('current_L2', 0) +
+                                       hmdata.get('current_L3', 0)) / 3, 3)
+    values['/Ac/Power'] = hmdata.get('positive_active_demand', 0) - hmdata.get('negative_active_demand', 0)
+    values['/Ac/Energy/Forward'] = hmdata.get('positive_active_energy', 0)
+    values['/Ac/Energy/Reverse'] = hmdata.get('negative_active_energy', 0)
+    for phase in ('L1', 'L2', 'L3'):
+        values[f'/Ac/{phase}/Voltage'] = hmdata.get(f'voltage_{phase}', 0)
+        values[f'/Ac/{phase}/Current'] = hmdata.get(f'current_{phase}', 0)
+        values[f'/Ac/{phase}/Power'] = hmdata.get(f'positive_active_demand_{phase}', 0) - \
+                                       hmdata.get(f'negative_active_demand_{phase}', 0)
+        values[f'/Ac/{phase}/Energy/Forward'] = hmdata.get(f'positive_active_energy_{phase}', 0)
+        values[f'/Ac/{phase}/Energy/Reverse'] = hmdata.get(f'negative_active_energy_{phase}', 0)
+    return values
+
+
+def bench_record(home_manager, datagram, frames):
+    # The fill and read back of a frame: a new dict read with .get() on string keys, like before the record,
+    # against the record of the decoder filled in place and read by the Layout of the bridge, which publishes
+    # every path of the frame. Both from the same unpacked values.
+    index = Measurements.INDEX
+    home_manager.datagram = datagram
+    home_manager._decode_data()
+    record = home_manager.hmdata
+    plan, = home_manager.plans.values()
+    values = plan.struct.unpack_from(datagram, plan.offset)
+    keys = plan.keys
+    scales = plan.scales
+    # the values and scales of the channels in the frame only, as the plan had them for the dict
+    get_channels = operator.itemgetter(*[index[key] for key in keys])
+    raw, dict_scales = get_channels(plan.get_values(values + PAD)), get_channels(scales)
+    layout = dbus_homemanager.Layout.get(record.present)
+
+    def dict_frame():
+        hmdata = dict(zip(keys, map(operator.truediv, raw, dict_scales)))
+        hmdata['serial'] = record.serial
+        return legacy_read(hmdata)
+
+    def record_frame():
+        record.STRUCT.pack_into(record.data, 0, *map(operator.truediv, plan.get_values(values + PAD), scales))
+        return layout.publish(record.data)
+
+    address = record.data.buffer_info()[0]
+    before = measure('dict fill + .get() read', dict_frame, frames)
+    after = measure('record fill + Layout read', record_frame, frames)
+    legacy, values = dict_frame(), record_frame()
+    # the Layout publishes frequency, power factor, reactive and apparent power too
+    print(f'fill and read {before / len(legacy) / (after / len(values)):.1f}x faster per path, '
+          f'{len(values)} paths against {len(legacy)}')
+    assert legacy == {path: values[path] for path in legacy}, 'record and dict publish different values'
+    assert home_manager.hmdata is record and record.data.buffer_info()[0] == address, 'the record was reallocated'
+
+
+def measure(name, func, frames):
+    func()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    for _ in range(frames):
+        func()
+    wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    print(f'{name:<24} {cpu / frames * 1e6:9.1f} us/frame cpu {frames / wall:10.0f} frames/s')
+    return cpu / frames
+
+
+def unpack_peak(home_manager):
+    # The allocations the frame plan cannot avoid: the tuple of the unpacked values and the scaled values
+    plan, = home_manager.plans.values()
+    record = home_manager.hmdata
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    values = plan.struct.unpack_from(home_manager.datagram, plan.offset)
+    record.STRUCT.pack_into(record.data, 0, *map(operator.truediv, plan.get_values(values + PAD), plan.scales))
+    peak = tracemalloc.get_traced_memory()[1] - start
+    tracemalloc.stop()
+    return peak
+
+
+def check_allocations(home_manager, tx, datagram, frames=2000):
+    # Every frame goes through the socket and the receive path of the bridge, recvmsg_into included. Per frame
+    # the peak of the memory allocated on top of what was live before must stay within the unpacked values of
+    # the frame plan plus ALLOCATION_SLACK (the ancillary data list of recvmsg_into and the like), a dict or
+    # list per frame exceeds it. The allocated blocks must not grow, one object left behind per frame fails.
+    def receive():
+        tx.send(datagram)
+        assert home_manager._recv_data(), 'no frame received'
+        home_manager._decode_data()
+
+    for _ in range(100): # warm up the plan, the buffer views and the caches
+        receive()
+    accepted = home_manager.stats.accepted
+    budget = unpack_peak(home_manager) + ALLOCATION_SLACK
+
+    tracemalloc.start()
+    receive() # tracemalloc itself allocates on the first frame
+    peak = 0
+    for _ in range(frames):
+        start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        receive()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - start)
+    tracemalloc.stop()
+
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    for _ in range(frames):
+        receive()
+    gc.collect()
+    retained = (sys.getallocatedblocks() - blocks) / frames
+
+    assert home_manager.stats.accepted - accepted == 2 * frames + 1, 'frames were rejected'
+    print(f'allocations {peak} bytes/frame peak (budget {budget}), {retained:.3f} blocks/frame retained')
+    assert peak <= budget, f'receiving and decoding a frame allocates {peak} bytes, budget {budget}'
+    assert retained < 0.01, f'receiving and decoding retains {retained:.3f} blocks per frame'
+
+
+if __name__ == "__main__":
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f'{platform.machine()} {platform.processor() or platform.platform()} python {platform.python_version()}')
+
+    datagram = FrameGenerator().next()
+    rx, tx = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    home_manager = HomeManager20(sock=rx, check_sequence=False) # the same frame over and over
+    home_manager.datagram = datagram
+
+    with open(os.devnull, 'w') as devnull:
+        before = measure('legacy _decode_data', lambda: legacy_decode(datagram, devnull), frames)
+    after = measure('frame plan _decode_data', home_manager._decode_data, frames)
+    print(f'speedup {before / after:.1f}x')
+    check_allocations(home_manager, tx, datagram)
+    bench_record(home_manager, datagram, frames)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Time from process start until the bridge publishes the first live /Ac/Power, the time the grid meter
+# is missing on dbus after a reboot or a restart by daemontools.
+#
+# Every run starts a fresh interpreter that loads dbus-homemanager.py with FakeVeDbusService (and the
+# FakeGLib main loop when gi is missing), creates the bridge and runs until the first frame of the emulated
+# meter is published. The emulator of tests/soak.py sends 100 frames/s, so waiting for a frame adds at most
+# 10 ms. With --warm the runs start from the state cache written by the first one, like after a reboot.
+#
+#   python3 tests/bench_startup.py [--runs 10] [--warm]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+STAGES = ('interpreter', 'imports', 'services', 'cached', 'live')
+
+
+def child(started, state_file):
+    # stages in ms since the parent started this process
+    stages = {'interpreter': (time.time() - started) * 1000}
+    sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+    from fake_vedbus import load_dbus_homemanager
+    dbus_homemanager = load_dbus_homemanager()
+    glib = dbus_homemanager.gobject
+    stages['imports'] = (time.time() - started) * 1000
+
+    bridge = dbus_homemanager.DbusSmaBridge(state_file=state_file)
+    stages['services'] = (time.time() - started) * 1000
+    if bridge.services:
+        stages['cached'] = stages['services']
+        assert all(service._dbusservice.registered for service in bridge.services.values())
+
+    deadline = time.monotonic() + 10
+    while not any(service.live for service in bridge.services.values()):
+        if time.monotonic() > deadline:
+            raise SystemExit('no frame from the emulator within 10 s')
+        if hasattr(glib, 'iteration'): # FakeGLib
+            glib.iteration(0.01)
+        else:
+            glib.MainContext.default().iteration(False)
+    stages['live'] = (time.time() - started) * 1000
+    service = next(service for service in bridge.services.values() if service.live)
+    assert service._dbusservice.registered and '/Ac/Power' in service._dbusservice.publish_times
+    print(json.dumps(stages))
+
+
+def run(state_file):
+    started = time.time()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', repr(started), '--state', state_file],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Startup time of dbus-homemanager.py until the first live /Ac/Power')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--warm', action='store_true', help='start from the state cache of a first run')
+    parser.add_argument('--child', type=float, help=argparse.SUPPRESS)
+    parser.add_argument('--state', default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args.child, args.state)
+        sys.exit(0)
+
+    soak = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'soak.py')
+    emulator = subprocess.Popen([sys.executable, soak, 'emulate', '--rate', '100', '--malformed', '0', '--inverter', '0'],
+                                stdout=subprocess.DEVNULL)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            state_file = os.path.join(directory, 'state.json') if args.warm else ''
+            if args.warm:
+                run(state_file) # writes the state cache
+            results = [run(state_file) for _ in range(args.runs)]
+    finally:
+        emulator.terminate()
+        emulator.wait()
+
+    print(f'{"ms since process start":<24} {"median":>8} {"min":>8} {"max":>8}')
+    for stage in STAGES:
+        values = [result[stage] for result in results if stage in result]
+        if values:
+            print(f'{stage:<24} {statistics.median(values):8.1f} {min(values):8.1f} {max(values):8.1f}')
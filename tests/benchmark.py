@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Offline benchmark of the hot path: HomeManager20._decode_data and DbusSmaService._update for every
+# synthetic frame layout in speedwire_frames.SCENARIOS. _update runs against FakeVeDbusService and reads
+# the frames from a local socketpair, so no meter, network or dbus daemon is needed.
+#
+#   python3 tests/benchmark.py [frames] [scenario ...]
+
+import os
+import platform
+import socket
+import sys
+import time
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+from fake_vedbus import load_dbus_homemanager
+from homemanager_decoder import HomeManager20
+from speedwire_frames import SCENARIOS, FrameGenerator
+
+dbus_homemanager = load_dbus_homemanager()
+
+
+def generate(scenario, count=500):
+    generator = FrameGenerator(**SCENARIOS[scenario])
+    return [generator.next() for _ in range(count)]
+
+
+def bench_decode(frames, count):
+    rx, tx = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    home_manager = HomeManager20(sock=rx, check_sequence=False) # the frames repeat
+
+    start = time.process_time()
+    for i in range(count):
+        home_manager.datagram = frames[i % len(frames)]
+        home_manager._decode_data()
+    elapsed = time.process_time() - start
+
+    rx.close()
+    tx.close()
+    # a frame the decoder rejects is cheap, make sure the rejecting path was not what got timed
+    assert home_manager.stats.accepted == count, f'{home_manager.stats.accepted} of {count} frames decoded'
+    return elapsed / count
+
+
+def bench_update(frames, count):
+    # a full tick: select, recv, decode and publish to the fake dbus service
+    rx, tx = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    service = dbus_homemanager.DbusSmaService('com.victronenergy.grid.benchmark', 40, home_manager=HomeManager20(sock=rx, check_sequence=False))
+
+    elapsed = 0
+    for i in range(count):
+        tx.send(frames[i % len(frames)])
+        start = time.process_time()
+        service._update()
+        elapsed += time.process_time() - start
+
+    rx.close()
+    tx.close()
+    accepted = service.home_manager.stats.accepted
+    assert accepted == count, f'{accepted} of {count} frames decoded'
+    assert '/Ac/Power' in service._dbusservice.publish_times, '/Ac/Power was never published'
+    return elapsed / count
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    scenarios = sys.argv[2:] or list(SCENARIOS)
+    print(f'{platform.machine()} {platform.processor() or platform.platform()} python {platform.python_version()}')
+    print(f'{"scenario":<22} {"decode us/frame":>16} {"frames/s":>10} {"update us/frame":>16} {"frames/s":>10}')
+
+    for scenario in scenarios:
+        frames = generate(scenario)
+        decode = bench_decode(frames, count)
+        update = bench_update(frames, count)
+        print(f'{scenario:<22} {decode * 1e6:16.1f} {1 / decode:10.0f} {update * 1e6:16.1f} {1 / update:10.0f}')
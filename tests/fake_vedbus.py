@@ -0,0 +1,190 @@
+# In-process stand-ins for vedbus and GLib so dbus-homemanager.py can be benchmarked without a dbus daemon.
+#
+# FakeVeDbusService behaves like the VeDbusService of velib_python as far as the bridge can tell: a write of a
+# changed value emits one PropertiesChanged (GetText included), writes inside "with service" are collected into
+# one ItemsChanged. The real gi and dbus modules are used when they are installed, a small selectors based
+# GLib replacement otherwise.
+
+import heapq
+import importlib.util
+import os
+import selectors
+import sys
+import time
+import types
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class FakeVeDbusService:
+    def __init__(self, servicename, bus=None, register=True):
+        self.servicename = servicename
+        self.registered = False
+        self.values = {}
+        self.gettext = {}
+        self.onchange = {}
+        self.signals = 0
+        self.writes = 0
+        self.publish_times = {} # path -> monotonic time of the last change
+        self._changes = None
+        if register:
+            self.register()
+
+    def register(self):
+        self.registered = True
+
+    def add_path(self, path, value, description='', writeable=False, onchangecallback=None, gettextcallback=None,
+                 valuetype=None, itemtype=None):
+        self.values[path] = value
+        self.gettext[path] = gettextcallback
+        self.onchange[path] = onchangecallback
+
+    def get_text(self, path):
+        callback = self.gettext.get(path)
+        return callback(path, self.values[path]) if callback else str(self.values[path])
+
+    def __contains__(self, path):
+        return path in self.values
+
+    def __getitem__(self, path):
+        return self.values[path]
+
+    def __setitem__(self, path, value):
+        self.writes += 1
+        if self.values[path] == value:
+            return
+        self.values[path] = value
+        self.publish_times[path] = time.monotonic()
+        change = {'Value': value, 'Text': self.get_text(path)}
+        if self._changes is None:
+            self.signals += 1 # PropertiesChanged
+        else:
+            self._changes[path] = change
+
+    def __delitem__(self, path):
+        del self.values[path]
+
+    def __enter__(self):
+        self._changes = {}
+        return self
+
+    def __exit__(self, *exc):
+        if self._changes:
+            self.signals += 1 # ItemsChanged
+        self._changes = None
+
+
+class FakeGLib(types.ModuleType):
+    # the part of GLib the bridge uses: timers, IO watches, unix signals and a main loop to run them
+    PRIORITY_HIGH = -100
+    PRIORITY_DEFAULT = 0
+    IO_IN = 1
+    IO_OUT = 4
+    IO_ERR = 8
+    IO_HUP = 16
+
+    def __init__(self):
+        super().__init__('GLib')
+        self._selector = selectors.PollSelector() # like GLib: fds are polled by number, a dup2 keeps its watch
+        self._timers = []
+        self._next_id = 1
+        self._removed = set()
+
+    def _source_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def timeout_add(self, interval, callback, *args):
+        source = self._source_id()
+        heapq.heappush(self._timers, (time.monotonic() + interval / 1000, source, interval, callback, args))
+        return source
+
+    def timeout_add_seconds(self, interval, callback, *args):
+        return self.timeout_add(interval * 1000, callback, *args)
+
+    def io_add_watch(self, fd, priority, condition, callback, *args):
+        source = self._source_id()
+        events = selectors.EVENT_WRITE if condition & self.IO_OUT else selectors.EVENT_READ
+        self._selector.register(fd, events, (source, fd, condition, callback, args))
+        return source
+
+    def unix_signal_add(self, priority, signum, callback, *args):
+        return self._source_id()
+
+    def source_remove(self, source):
+        self._removed.add(source)
+        for key in list(self._selector.get_map().values()):
+            if key.data[0] == source:
+                self._selector.unregister(key.fileobj)
+
+    def iteration(self, timeout=0.1):
+        # run the timers that are due, then wait for IO until the next timer or the timeout
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, source, interval, callback, args = heapq.heappop(self._timers)
+            if source in self._removed:
+                continue
+            if callback(*args):
+                heapq.heappush(self._timers, (now + interval / 1000, source, interval, callback, args))
+        if self._timers:
+            timeout = max(0, min(timeout, self._timers[0][0] - time.monotonic()))
+        if not self._selector.get_map():
+            time.sleep(timeout)
+            return
+        for key, _ in self._selector.select(timeout):
+            source, fd, condition, callback, args = key.data
+            if not callback(fd, condition, *args):
+                self.source_remove(source)
+
+    def MainLoop(self):
+        glib = self
+
+        class MainLoop:
+            running = False
+
+            def run(self):
+                self.running = True
+                while self.running:
+                    glib.iteration()
+
+            def quit(self):
+                self.running = False
+
+        return MainLoop()
+
+
+def install():
+    # vedbus is always the fake one, gi and dbus only when they are missing
+    vedbus = types.ModuleType('vedbus')
+    vedbus.VeDbusService = FakeVeDbusService
+    sys.modules['vedbus'] = vedbus
+
+    try:
+        from gi.repository import GLib
+    except ImportError:
+        GLib = FakeGLib()
+        gi = types.ModuleType('gi')
+        gi.repository = types.ModuleType('gi.repository')
+        gi.repository.GLib = GLib
+        sys.modules.update({'gi': gi, 'gi.repository': gi.repository})
+
+    try:
+        import dbus.mainloop.glib
+    except ImportError:
+        dbus = types.ModuleType('dbus')
+        dbus.SystemBus = dbus.SessionBus = lambda private=False: None
+        dbus.mainloop = types.ModuleType('dbus.mainloop')
+        dbus.mainloop.glib = types.ModuleType('dbus.mainloop.glib')
+        dbus.mainloop.glib.DBusGMainLoop = lambda set_as_default=False: None
+        sys.modules.update({'dbus': dbus, 'dbus.mainloop': dbus.mainloop, 'dbus.mainloop.glib': dbus.mainloop.glib})
+    return GLib
+
+
+def load_dbus_homemanager():
+    # dbus-homemanager.py is not importable by name because of the dash
+    install()
+    sys.path.insert(1, ROOT)
+    spec = importlib.util.spec_from_file_location('dbus_homemanager', os.path.join(ROOT, 'dbus-homemanager.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# Soak and load test of the bridge without a meter or a dbus daemon.
+#
+# A meter emulator in a child process sends frames of one or more meters to the multicast group on
+# loopback (TTL 0), mixed with malformed frames and inverter traffic. The bridge runs in this process with
+# DbusSmaService on FakeVeDbusService, the same event driven, draining setup as on the GX. The report has
+# CPU time, RSS growth, latency percentiles and the drop rate, as JSON to compare across releases:
+#
+#   python3 tests/soak.py --meters 2 --rate 100 --duration 600 --report soak-v1.json
+#   python3 tests/soak.py --meters 2 --rate 100 --duration 600 --compare soak-v1.json
+#   python3 tests/soak.py --meters 2 --rate 100 --duration 600 --receiver-process --compare soak-v1.json
+#   python3 tests/soak.py emulate --meters 3 --rate 5    # the emulator alone, for a bridge on this host
+
+import argparse
+import heapq
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+from fake_vedbus import ROOT, load_dbus_homemanager
+from homemanager_decoder import MCAST_GRP, MCAST_PORT, Histogram
+from speedwire_frames import SCENARIOS, FrameGenerator, inverter_frame
+
+FIRST_SERIAL = 1900000000
+COUNTERS = ('accepted', 'wrong_header', 'wrong_protocol', 'wrong_serial', 'too_short', 'unknown_obis',
+            'duplicates', 'reordered', 'lost')
+
+
+def malformed(frame, rand):
+    # a broken variant of a valid frame, each kind hits another check of the decoder
+    kind = rand.randrange(4)
+    if kind == 0:
+        return frame[:rand.randrange(1, 28)] # cut off inside the header
+    if kind == 1:
+        return b'SMB\x00' + frame[4:] # wrong magic
+    if kind == 2:
+        return frame[:14] + b'\xff\xff' + frame[16:] # data2 longer than the datagram
+    return bytes(rand.getrandbits(8) for _ in range(rand.randrange(28, 200))) # noise
+
+
+def emulate(meters=1, rate=1.0, malformed_share=0.0, inverter_rate=0.0, seed=1):
+    # Sends until SIGTERM and returns the counts. Every meter is a FrameGenerator with its own layout, the
+    # frames of all meters are interleaved by their deadlines. A sender that falls behind sends in a burst,
+    # like a switch releasing a queue.
+    rand = random.Random(seed)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 0)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    scenarios = list(SCENARIOS)
+    period = 1 / rate
+    generators = [FrameGenerator(serial=FIRST_SERIAL + i, period_ms=max(1, round(period * 1000)), seed=seed + i,
+                                 **SCENARIOS[scenarios[i % len(scenarios)]]) for i in range(meters)]
+
+    start = time.monotonic()
+    queue = [(start + i * period / meters, i) for i in range(meters)]
+    if inverter_rate:
+        queue.append((start, -1))
+    heapq.heapify(queue)
+    counts = {'frames': 0, 'malformed': 0, 'inverter': 0, 'late_max_ms': 0.0}
+    running = [True]
+    signal.signal(signal.SIGTERM, lambda signum, frame: running.clear())
+    while running:
+        deadline, meter = heapq.heappop(queue)
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            counts['late_max_ms'] = max(counts['late_max_ms'], round(-delay * 1000, 3))
+        if meter < 0:
+            sock.sendto(inverter_frame(), (MCAST_GRP, MCAST_PORT))
+            counts['inverter'] += 1
+            heapq.heappush(queue, (deadline + 1 / inverter_rate, meter))
+            continue
+        frame = generators[meter].next()
+        sock.sendto(frame, (MCAST_GRP, MCAST_PORT))
+        counts['frames'] += 1
+        if malformed_share and rand.random() < malformed_share:
+            sock.sendto(malformed(frame, rand), (MCAST_GRP, MCAST_PORT))
+            counts['malformed'] += 1
+        heapq.heappush(queue, (deadline + period, meter))
+    sock.close()
+    return counts
+
+
+def rss_kb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def receiver_cpu(home_manager):
+    # CPU seconds of the receiver process of --receiver-process, process_time only counts this one
+    process = getattr(home_manager, 'process', None)
+    if process is None:
+        return 0.0
+    with open(f'/proc/{process.pid}/stat') as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def iterate(glib, timeout=0.1):
+    if hasattr(glib, 'iteration'): # FakeGLib
+        glib.iteration(timeout)
+    else:
+        glib.MainContext.default().iteration(False) or time.sleep(0.001)
+
+
+def merged(histograms):
+    total = Histogram()
+    for histogram in histograms:
+        total.buckets = [a + b for a, b in zip(total.buckets, histogram.buckets)]
+        total.count += histogram.count
+        total.total += histogram.total
+        total.max = max(total.max, histogram.max)
+    return total
+
+
+def latencies(bridge):
+    stats = bridge.home_manager.stats
+    services = bridge.services.values()
+    histograms = {'select': stats.select, 'recv': stats.recv, 'decode': stats.decode,
+                  'publish': merged(service.publish_time for service in services),
+                  'end_to_end': merged(service.end_to_end for service in services)}
+    return {stage: {'p50': histogram.percentile(50), 'p99': histogram.percentile(99), 'max': histogram.max,
+                    'mean': round(histogram.mean(), 1)} for stage, histogram in histograms.items()}
+
+
+def reset_latencies(bridge):
+    # the frames of the warm-up, with the first services being created, do not count
+    stats = bridge.home_manager.stats
+    stats.select, stats.recv, stats.decode = Histogram(), Histogram(), Histogram()
+    for service in bridge.services.values():
+        service.publish_time, service.end_to_end = Histogram(), Histogram()
+
+
+def soak(args):
+    dbus_homemanager = load_dbus_homemanager()
+    glib = dbus_homemanager.gobject
+    bridge = dbus_homemanager.DbusSmaBridge(state_file=None, receiver_process=args.receiver_process)
+    home_manager = bridge.home_manager
+
+    emulator = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'emulate', '--meters', str(args.meters),
+                                 '--rate', str(args.rate), '--malformed', str(args.malformed), '--inverter',
+                                 str(args.inverter)], stdout=subprocess.PIPE, text=True)
+    start = time.monotonic()
+    try:
+        while time.monotonic() < start + args.warmup:
+            iterate(glib)
+        reset_latencies(bridge)
+        wall, cpu, rss = time.monotonic(), time.process_time() + receiver_cpu(home_manager), rss_kb()
+        accepted = home_manager.stats.accepted
+        rss_max = rss
+        progress = wall + args.interval
+        while time.monotonic() < wall + args.duration:
+            iterate(glib)
+            now = time.monotonic()
+            if now >= progress:
+                progress = now + args.interval
+                rss_max = max(rss_max, rss_kb())
+                frames = home_manager.stats.accepted - accepted
+                e2e = latencies(bridge)['end_to_end']
+                print(f'{now - wall:8.0f} s {frames / (now - wall):8.1f} frames/s cpu '
+                      f'{(time.process_time() - cpu) / (now - wall) * 100:5.1f} % rss {rss_kb()} kB '
+                      f'e2e p99 {e2e["p99"]} us lost {home_manager.stats.lost}', file=sys.stderr)
+        elapsed, cpu = time.monotonic() - wall, time.process_time() + receiver_cpu(home_manager) - cpu
+        frames = home_manager.stats.accepted - accepted
+        rss_end = rss_kb()
+    finally:
+        emulator.terminate()
+        sent = json.loads(emulator.communicate()[0] or '{}')
+    # the frames still in flight when the emulator stopped
+    settle = time.monotonic() + 0.5
+    while time.monotonic() < settle:
+        iterate(glib)
+
+    stats = home_manager.stats
+    counters = {name: getattr(stats, name) for name in COUNTERS}
+    counters['coalesced'] = home_manager.frames_coalesced
+    received = stats.accepted + home_manager.frames_coalesced
+    return {
+        'version': version(),
+        'python': platform.python_version(),
+        'machine': f'{platform.machine()} {platform.processor() or platform.platform()}',
+        'config': {'meters': args.meters, 'rate': args.rate, 'malformed': args.malformed, 'inverter': args.inverter,
+                   'duration': args.duration, 'warmup': args.warmup, 'receiver_process': args.receiver_process},
+        'sent': sent,
+        'decoder': counters,
+        'services': len(bridge.services),
+        'drop_rate': round(1 - received / sent['frames'], 6) if sent.get('frames') else None,
+        'cpu': {'seconds': round(cpu, 3), 'percent': round(cpu / elapsed * 100, 2),
+                'us_per_frame': round(cpu / frames * 1e6, 1) if frames else None},
+        'rss_kb': {'start': rss, 'end': rss_end, 'max': max(rss_max, rss_end), 'growth': rss_end - rss,
+                   'growth_per_hour': round((rss_end - rss) / elapsed * 3600)},
+        'latency_us': latencies(bridge),
+    }
+
+
+def flatten(report, prefix=''):
+    for key, value in report.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f'{prefix}{key}', value
+
+
+def compare(report, baseline):
+    # every number of both reports side by side, the config first to see whether they compare at all
+    old = dict(flatten(baseline))
+    print(f'{"":<32} {baseline.get("version") or "baseline":>14} {report.get("version") or "this run":>14}')
+    for name, value in flatten(report):
+        if name not in old:
+            continue
+        change = f'{(value - old[name]) / old[name] * 100:+7.1f} %' if old[name] else ''
+        print(f'{name:<32} {old[name]:>14} {value:>14} {change}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Soak and load test of dbus-homemanager.py with emulated meters')
+    parser.add_argument('mode', nargs='?', choices=('soak', 'emulate'), default='soak')
+    parser.add_argument('--meters', type=int, default=1, help='number of emulated meters, default 1')
+    parser.add_argument('--rate', type=float, default=1.0, help='frames per second of every meter, default 1')
+    parser.add_argument('--malformed', type=float, default=0.01, help='share of frames followed by a broken one, default 0.01')
+    parser.add_argument('--inverter', type=float, default=1.0, help='inverter frames per second, default 1')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to measure after the warm-up, default 60')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds before the measurement starts, default 5')
+    parser.add_argument('--interval', type=float, default=10, help='seconds between progress lines, default 10')
+    parser.add_argument('--receiver-process', action='store_true', help='run the bridge with its receiver process')
+    parser.add_argument('--report', metavar='FILE', help='write the report as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with the JSON report of an earlier run')
+    args = parser.parse_args()
+
+    if args.mode == 'emulate':
+        print(json.dumps(emulate(args.meters, args.rate, args.malformed, args.inverter)))
+        sys.exit(0)
+
+    report = soak(args)
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(report, file, indent=1)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(report, json.load(file))
+    else:
+        print(json.dumps(report, indent=1))
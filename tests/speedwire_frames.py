@@ -0,0 +1,108 @@
+# Synthetic Speedwire frames for the benchmarks, captures and the meter emulator.
+#
+# The generator produces Home Manager 2.0 and Energy Meter frames, single or three phase, with optional
+# extra or unknown OBIS channels. Values follow a slowly varying load so consecutive frames differ the way
+# real ones do: the power of every phase moves, the energy counters keep counting.
+
+import math
+import random
+import struct
+
+SUSY_HOME_MANAGER_20 = 0x0174
+SUSY_ENERGY_METER = 0x010e
+
+LAYOUTS = {
+    'hm20': {'susy': SUSY_HOME_MANAGER_20, 'frequency': True, 'firmware': (2, 3, 4, 'R')},
+    'em10': {'susy': SUSY_ENERGY_METER, 'frequency': False, 'firmware': (1, 2, 4, 'R')},
+}
+
+# channel indices with an actual (0x04) and a counter (0x08) value, for the totals and for L1
+TOTAL_CHANNELS = (1, 2, 3, 4, 9, 10)
+PHASE_CHANNELS = (0x15, 0x16, 0x17, 0x18, 0x1d, 0x1e)
+PHASE_OFFSET = 0x14
+
+
+class FrameGenerator:
+    def __init__(self, layout='hm20', phases=3, serial=1901234567, period_ms=1000, extra_channels=(), seed=1):
+        # extra_channels: (obis id, value width in bytes) appended after the phases, known or unknown to the decoder
+        self.layout = LAYOUTS[layout]
+        self.phases = phases
+        self.serial = serial
+        self.period_ms = period_ms
+        self.extra_channels = tuple(extra_channels)
+        self.random = random.Random(seed)
+        self.ticker = 0
+        self.energy = [[4.5e10, 1.8e10] for _ in range(phases)] # imported and exported Ws per phase
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def next(self):
+        self.ticker = (self.ticker + self.period_ms) & 0xffffffff
+        t = self.ticker / 1000
+
+        phases = []
+        for phase in range(self.phases):
+            power = 800 * math.sin(t / 60 + phase) + self.random.uniform(-50, 50) # W, negative is export
+            voltage = 230 + 3 * math.sin(t / 300 + phase) + self.random.uniform(-0.5, 0.5)
+            self.energy[phase][0 if power >= 0 else 1] += abs(power) * self.period_ms / 1000
+            phases.append((power, voltage, abs(power) / voltage))
+
+        power = sum(phase[0] for phase in phases)
+        data = self._measurement(TOTAL_CHANNELS, power, power * 0.2, sum(energy[0] for energy in self.energy),
+                                 sum(energy[1] for energy in self.energy))
+        data += struct.pack('>II', 0x000d0400, 980)
+        if self.layout['frequency']:
+            data += struct.pack('>II', 0x000e0400, round(50000 + self.random.uniform(-20, 20)))
+
+        for phase, (power, voltage, current) in enumerate(phases):
+            offset = PHASE_OFFSET * phase
+            data += self._measurement([channel + offset for channel in PHASE_CHANNELS], power, power * 0.2,
+                                      *self.energy[phase])
+            data += struct.pack('>II', (0x1f + offset) << 16 | 0x0400, round(current * 1000))
+            data += struct.pack('>II', (0x20 + offset) << 16 | 0x0400, round(voltage * 1000))
+            data += struct.pack('>II', (0x21 + offset) << 16 | 0x0400, 980)
+
+        for obis, width in self.extra_channels:
+            data += struct.pack('>I', obis) + self.random.getrandbits(8 * width).to_bytes(width, 'big')
+
+        major, minor, build, revision = self.layout['firmware']
+        data += struct.pack('>I4B', 0x90000000, major, minor, build, ord(revision))
+        return build_frame(data, self.serial, self.ticker, self.layout['susy'])
+
+    def _measurement(self, channels, active, reactive, energy_in, energy_out):
+        # import and export of active, reactive and apparent power with their counters
+        apparent = math.hypot(active, reactive)
+        demands = (max(active, 0), max(-active, 0), max(reactive, 0), max(-reactive, 0),
+                   apparent if active >= 0 else 0, apparent if active < 0 else 0)
+        counters = (energy_in, energy_out, energy_in * 0.2, energy_out * 0.2, energy_in * 1.02, energy_out * 1.02)
+
+        data = b''
+        for channel, demand, counter in zip(channels, demands, counters):
+            data += struct.pack('>II', channel << 16 | 0x0400, round(demand * 10))
+            data += struct.pack('>IQ', channel << 16 | 0x0800, round(counter))
+        return data
+
+
+def build_frame(data, serial, ticker=0, susy=SUSY_HOME_MANAGER_20, protocol=0x6069):
+    # SMA header, group tag, data2 tag with the measurements and the end tag
+    data2 = struct.pack('>HHII', protocol, susy, serial, ticker) + data
+    return (b'SMA\x00' + struct.pack('>HHI', 4, 0x02a0, 1) + struct.pack('>HH', len(data2), 0x0010) + data2 +
+            struct.pack('>HH', 0, 0))
+
+
+def inverter_frame(serial=1234567890):
+    # Speedwire traffic of an inverter on the same multicast group, protocol 0x6065 instead of 0x6069
+    return build_frame(bytes(40), serial, protocol=0x6065)
+
+
+SCENARIOS = {
+    'hm20-3phase': {'layout': 'hm20', 'phases': 3},
+    'hm20-1phase': {'layout': 'hm20', 'phases': 1},
+    'em10-3phase': {'layout': 'em10', 'phases': 3},
+    'em10-1phase': {'layout': 'em10', 'phases': 1},
+    'hm20-extra-channels': {'layout': 'hm20', 'phases': 3, 'extra_channels': ((0x00120400, 4), (0x00130800, 8))},
+}
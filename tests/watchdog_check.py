@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# The watchdog of DbusSmaService against a meter sending every 200 ms on the FakeGLib main loop: single lost
+# frames must not make the meter stale, a meter that went silent must be stale within the limit.
+#
+#   python3 tests/watchdog_check.py
+
+import os
+import sys
+import time
+
+sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+from fake_vedbus import load_dbus_homemanager
+
+PERIOD = 0.2
+
+
+def run(frames, lost=(), silence=3.0):
+    # feeds the frames that are not lost every PERIOD, then waits; returns the stale events as seconds since
+    # the last frame
+    dbus_homemanager = load_dbus_homemanager()
+    glib = dbus_homemanager.gobject
+    events = []
+    last = [None]
+    watchdog = dbus_homemanager.Watchdog(lambda: events.append(time.monotonic() - last[0]), lambda: None)
+    start = time.monotonic()
+    for frame in range(frames):
+        deadline = start + frame * PERIOD
+        while time.monotonic() < deadline:
+            glib.iteration(deadline - time.monotonic())
+        if frame not in lost:
+            watchdog.feed()
+            last[0] = time.monotonic()
+    deadline = time.monotonic() + silence
+    while time.monotonic() < deadline:
+        glib.iteration(deadline - time.monotonic())
+    return events, watchdog
+
+
+if __name__ == "__main__":
+    events, watchdog = run(20, lost={8, 14}, silence=0)
+    assert not events, f'stale after {events} s with single lost frames'
+    print(f'single lost frames: not stale, limit {watchdog.limit():.2f} s')
+
+    events, watchdog = run(20, lost={8, 9}, silence=0)
+    assert not events, f'stale after {events} s with two lost frames in a row'
+    print(f'two lost frames in a row: not stale, limit {watchdog.limit():.2f} s')
+
+    events, watchdog = run(10, silence=2.0)
+    assert len(events) == 1 and watchdog.limit() <= events[0] < watchdog.limit() + 0.1, events
+    print(f'silent meter: stale after {events[0]:.2f} s')